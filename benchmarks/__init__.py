@@ -0,0 +1,4 @@
+"""Micro-benchmarks for pymoji, e.g.
+
+    $ python -m benchmarks.composite_bench
+"""
@@ -0,0 +1,70 @@
+"""Compares the marshmallow schema path against the compact annotation codecs
+as the face count grows.
+
+Usage:
+    $ python -m benchmarks.codec_bench
+"""
+from types import SimpleNamespace
+import timeit
+
+from pymoji import codec
+from pymoji.models import AnnotationsSchema
+
+
+FACE_COUNTS = (1, 2, 5, 10, 20)
+NUMBER = 200
+REPEAT = 5
+
+
+def make_face(index):
+    """Fakes a Google Vision API face annotation object."""
+    (left, top) = (index * 50, index * 30)
+    corners = [(left, top), (left + 40, top), (left + 40, top + 48), (left, top + 48)]
+    return SimpleNamespace(
+        bounding_poly=SimpleNamespace(vertices=[SimpleNamespace(x=x, y=y) for (x, y) in corners]),
+        detection_confidence=0.9950907230377197,
+        sorrow_likelihood=1,
+        anger_likelihood=1,
+        surprise_likelihood=2,
+        headwear_likelihood=5,
+        joy_likelihood=4,
+    )
+
+
+def schema_round_trip(faces):
+    """The old path: a fresh marshmallow schema per dump and per load."""
+    json_string = AnnotationsSchema().dumps({'faces': faces}).data
+    return AnnotationsSchema().loads(json_string).data
+
+
+def json_round_trip(faces):
+    """The fast path: rows plus the stdlib C encoder."""
+    return codec.decode_json(codec.encode_json({'faces': faces}))
+
+
+def binary_round_trip(faces):
+    """The compact binary path used by the annotation cache."""
+    return codec.unpack_faces(codec.pack_faces(faces))
+
+
+def main():
+    """Prints the best per-round-trip times and encoded sizes for each path."""
+    paths = (schema_round_trip, json_round_trip, binary_round_trip)
+    print('dump + load round trips, best of {} x {}'.format(REPEAT, NUMBER))
+    print('{:>6} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'faces', 'schema us', 'json us', 'binary us', 'json bytes', 'binary bytes'))
+    for count in FACE_COUNTS:
+        faces = [make_face(index) for index in range(count)]
+        assert schema_round_trip(faces) == json_round_trip(faces)
+        results = []
+        for path in paths:
+            best = min(timeit.repeat(lambda: path(faces), # pylint: disable=cell-var-from-loop
+                                     number=NUMBER, repeat=REPEAT))
+            results.append(best * 1e6 / NUMBER)
+        sizes = (len(codec.encode_json({'faces': faces})), len(codec.pack_faces(faces)))
+        print('{:>6} {:>12.1f} {:>12.1f} {:>12.1f} {:>12} {:>12}'.format(
+            count, *(results + list(sizes))))
+
+
+if __name__ == '__main__':
+    main()
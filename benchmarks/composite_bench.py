@@ -0,0 +1,81 @@
+"""Compares PIL's masked paste against a NumPy alpha blend for drawing emoji
+as the face count grows. This is why replace_faces pastes with PIL: paste is
+already a fused C loop, and the NumPy blend loses at every face count.
+
+Needs NumPy, which the app itself doesn't:
+
+    $ pip install numpy
+    $ python -m benchmarks.composite_bench [width] [height]
+"""
+import sys
+import timeit
+
+import numpy as np
+from PIL import Image
+
+
+FACE_COUNTS = (1, 2, 5, 10, 20)
+REPEAT = 5
+
+
+def make_placements(count, width, height):
+    """Lays out count emoji-sized sprites in a crowd-shot-like grid, with some
+    overlapping and running off the right edge."""
+    size = max(min(width, height) // 8, 16)
+    emoji = Image.new('RGBA', (size, size), (251, 200, 83, 200))
+    placements = []
+    for index in range(count):
+        (row, column) = divmod(index, 6)
+        placements.append((emoji, (column * size * 3 // 2, row * size)))
+    return placements
+
+
+def paste_emoji(image, placements):
+    """The PIL way, as in emoji.render_emoji: one masked paste per face."""
+    for emoji, position in placements:
+        image.paste(emoji, position, emoji)
+
+
+def blend_emoji(image, placements):
+    """The NumPy way: copies the region covered by emoji into one array,
+    alpha-blends every emoji into it in order, and pastes it back once."""
+    boxes = np.array([(left, top, left + emoji.width, top + emoji.height)
+                      for (emoji, (left, top)) in placements])
+    dest = np.clip(boxes, 0, [image.width, image.height] * 2)
+    source = dest - boxes[:, [0, 1, 0, 1]]
+    union = (int(dest[:, 0].min()), int(dest[:, 1].min()),
+             int(dest[:, 2].max()), int(dest[:, 3].max()))
+    pixels = np.array(image.crop(union), dtype=np.uint8)
+    dest -= [union[0], union[1], union[0], union[1]]
+
+    channels = len(image.getbands())
+    for (emoji, _), (left, top, right, bottom), (src_left, src_top, src_right, src_bottom) \
+            in zip(placements, dest, source):
+        sprite = np.asarray(emoji)[src_top:src_bottom, src_left:src_right]
+        alpha = sprite[:, :, 3:4].astype(np.uint16)
+        region = pixels[top:bottom, left:right]
+        # integer "over" blend with rounding: (src * a + dst * (255 - a)) / 255
+        blended = sprite[:, :, :channels] * alpha + region * (255 - alpha) + 127
+        region[...] = blended // 255
+    image.paste(Image.fromarray(pixels, image.mode), union[:2])
+
+
+def main(width=4032, height=3024):
+    """Prints the best per-image and per-face times for both ways."""
+    base = Image.new('RGB', (width, height), (40, 80, 120))
+    print('{}x{} image, best of {} runs'.format(width, height, REPEAT))
+    print('{:>6} {:>12} {:>12} {:>12} {:>12}'.format(
+        'faces', 'pil ms', 'pil ms/face', 'numpy ms', 'numpy ms/face'))
+    for count in FACE_COUNTS:
+        placements = make_placements(count, width, height)
+        results = []
+        for draw in (paste_emoji, blend_emoji):
+            image = base.copy()
+            run = lambda: draw(image, placements) # pylint: disable=cell-var-from-loop
+            best = min(timeit.repeat(run, number=1, repeat=REPEAT))
+            results.extend([best * 1000, best * 1000 / count])
+        print('{:>6} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(count, *results))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -39,3 +39,43 @@ PROJECT_ID = 'pymoji-176318'
 FACE_PAD = 0.05 # percentage to enlarge emoji beyond face bounding box
 MAX_RESULTS = 20
 USE_GVA_LABELS = True # whether or not to fallback on label analysis (slow)
+EMOJI_CDN_FALLBACK = True # download emoji missing from the bundled atlas (see buildemoji)
+EMOJI_CACHE_BYTES = 32 * 1024 * 1024 # LRU limit for resized emoji images
+EMOJI_SIZE_BUCKET = 4 # round emoji sizes up to this many pixels to share cached images
+EMOJI_QUALITY = 'fast' # default emoji resampling: 'fast', 'balanced' or 'best'
+# overrides of the likelihood/label to emoji rules, e.g. {'joy': {5: '1f602'}}
+# (see DEFAULT_EMOJI_RULES and EmojiTable in pymoji/emoji.py)
+EMOJI_RULES = None
+GIF_KEYFRAME_INTERVAL = 10 # frames between face detections in animated GIFs
+GIF_MAX_PIXELS = 25 * 1000 * 1000 # decoded pixels across all GIF frames, longer ones skip frames
+
+# Google Vision API client params
+VISION_POOL_SIZE = 2 # long-lived ImageAnnotatorClients (gRPC channels) per process
+VISION_BATCH_SIZE = 16 # images per batch annotate request (API limit is 16)
+
+DETECTION_MAX_SIZE = 1024 # longest side of the proxy image sent for face detection
+DETECTION_JPEG_QUALITY = 85
+
+# Annotation cache params (keyed by image content hash, skips repeat API calls)
+ANNOTATION_CACHE_MEMORY_BYTES = 4 * 1024 * 1024 # in-memory LRU tier
+ANNOTATION_CACHE_DIR = None # on-disk tier, e.g. '/tmp/pymoji-annotations', None to disable
+ANNOTATION_CACHE_DISK_BYTES = 256 * 1024 * 1024
+
+# Google Cloud Storage params
+CLOUD_UPLOAD_WORKERS = 3 # concurrent uploads per request (input, JSON, output)
+SPOOL_MAX_BYTES = 16 * 1024 * 1024 # per-artifact buffers spill to disk beyond this size
+DEDUP_UPLOADS = True # reuse earlier results for byte-identical uploads (see faces.process_image)
+
+# HTTP caching (see app.after_request)
+HTML_CACHE_SECONDS = 60 # max-age for finished results pages
+METADATA_CACHE_SIZE = 256 # parsed results JSON kept in memory for the results page
+METADATA_CACHE_TTL = 60 * 60 # seconds
+
+# Slack upload notifications (see pymoji/slack.py)
+SLACK_DIGEST_SECONDS = 10 # uploads within this long share one message
+SLACK_QUEUE_SIZE = 100 # unsent notifications held before dropping more
+
+# Background jobs (see pymoji/jobs.py)
+JOB_WORKERS = 4 # face runs in flight per web worker process
+JOB_HISTORY = 1000 # job status records kept in memory per process
+JOB_TIMEOUT = 10 * 60 # seconds before an unfinished job counts as lost (e.g. worker restart)
@@ -1,10 +1,13 @@
 """Script manager for running locally. Gunicorn is used to run the
 application on Google App Engine. See entrypoint in app.yaml.
 """
+import os
+
 from flask_script import Manager
 
-from pymoji.app import APP
-from pymoji.faces import process_path
+from pymoji.app import APP, get_storage, RENDERERS
+from pymoji.emoji import build_emoji_atlas, EMOJI_RESAMPLE, EMOJI_TABLE
+from pymoji.faces import get_demo_run, process_path, process_paths
 from pymoji.utils import process_folder, shell
 
 
@@ -28,6 +31,29 @@ def lint():
     #shell("static/js/node_modules/.bin/eslint --ext .js,.jsx,.json,.es6,.es static/js")
 
 
+@MANAGER.command
+def buildemoji(source=''):
+    """Downloads every emoji we can render into the bundled sprite sheet.
+
+    Re-run and commit pymoji/static/emoji/ whenever the humor rank changes,
+    including via the EMOJI_RULES setting.
+
+    Args:
+        source: optional local directory of the CDN's 128px <code>.png assets
+    """
+    build_emoji_atlas(EMOJI_TABLE.humor_rank, source_dir=source or None)
+
+
+@MANAGER.command
+def prerender():
+    """Renders the /emojivision/ demo with every renderer and quality, so web
+    workers only have to look it up. Run at deploy time."""
+    for renderer in RENDERERS:
+        for quality in sorted(EMOJI_RESAMPLE):
+            id_filename = get_demo_run(get_storage(), renderer, quality)
+            print('{} {}: {}'.format(renderer, quality, id_filename))
+
+
 @MANAGER.command
 def runface(image_path):
     """Processes faces in the given image.
@@ -39,13 +65,27 @@ def runface(image_path):
 
 
 @MANAGER.command
-def rundir(directory_path):
-    """Processes images in the given directory.
+def rundir(directory_path, batch_size=0, workers=1, manifest='', resume=False):
+    """Processes images in the given directory and its subdirectories.
 
     Args:
         directory_path: path to a directory to process images in.
+        batch_size: optional number of images per batched Vision API request.
+        workers: number of worker processes.
+        manifest: JSONL run manifest path, defaults to rundir-manifest.jsonl in the directory.
+        resume: skip images already processed according to the manifest.
     """
-    process_folder(directory_path, process_path)
+    batch_size = int(batch_size)
+    manifest_path = manifest or os.path.join(directory_path, 'rundir-manifest.jsonl')
+    kwargs = {
+        'workers': int(workers),
+        'manifest_path': manifest_path,
+        'resume': resume,
+    }
+    if batch_size > 1:
+        process_folder(directory_path, process_paths, batch_size=batch_size, **kwargs)
+    else:
+        process_folder(directory_path, process_path, **kwargs)
 
 
 @MANAGER.command
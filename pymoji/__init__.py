@@ -23,6 +23,31 @@ APP.config.from_envvar('PYMOJI_SETTINGS', silent=True)
 FACE_PAD = APP.config.get('FACE_PAD', 0.05)
 MAX_RESULTS = APP.config.get('MAX_RESULTS', 20)
 USE_GVA_LABELS = APP.config.get('USE_GVA_LABELS', False)
+EMOJI_CDN_FALLBACK = APP.config.get('EMOJI_CDN_FALLBACK', True)
+EMOJI_CACHE_BYTES = APP.config.get('EMOJI_CACHE_BYTES', 32 * 1024 * 1024)
+EMOJI_SIZE_BUCKET = APP.config.get('EMOJI_SIZE_BUCKET', 0)
+EMOJI_QUALITY = APP.config.get('EMOJI_QUALITY', 'fast')
+EMOJI_RULES = APP.config.get('EMOJI_RULES')
+GIF_KEYFRAME_INTERVAL = APP.config.get('GIF_KEYFRAME_INTERVAL', 10)
+GIF_MAX_PIXELS = APP.config.get('GIF_MAX_PIXELS', 25 * 1000 * 1000)
+VISION_POOL_SIZE = APP.config.get('VISION_POOL_SIZE', 1)
+VISION_BATCH_SIZE = APP.config.get('VISION_BATCH_SIZE', 16)
+DETECTION_MAX_SIZE = APP.config.get('DETECTION_MAX_SIZE')
+DETECTION_JPEG_QUALITY = APP.config.get('DETECTION_JPEG_QUALITY', 85)
+ANNOTATION_CACHE_MEMORY_BYTES = APP.config.get('ANNOTATION_CACHE_MEMORY_BYTES', 4 * 1024 * 1024)
+ANNOTATION_CACHE_DIR = APP.config.get('ANNOTATION_CACHE_DIR')
+ANNOTATION_CACHE_DISK_BYTES = APP.config.get('ANNOTATION_CACHE_DISK_BYTES', 0)
+CLOUD_UPLOAD_WORKERS = APP.config.get('CLOUD_UPLOAD_WORKERS', 3)
+SPOOL_MAX_BYTES = APP.config.get('SPOOL_MAX_BYTES', 16 * 1024 * 1024)
+DEDUP_UPLOADS = APP.config.get('DEDUP_UPLOADS', False)
+HTML_CACHE_SECONDS = APP.config.get('HTML_CACHE_SECONDS', 0)
+METADATA_CACHE_SIZE = APP.config.get('METADATA_CACHE_SIZE', 256)
+METADATA_CACHE_TTL = APP.config.get('METADATA_CACHE_TTL', 60 * 60)
+SLACK_DIGEST_SECONDS = APP.config.get('SLACK_DIGEST_SECONDS', 10)
+SLACK_QUEUE_SIZE = APP.config.get('SLACK_QUEUE_SIZE', 100)
+JOB_WORKERS = APP.config.get('JOB_WORKERS', 4)
+JOB_HISTORY = APP.config.get('JOB_HISTORY', 1000)
+JOB_TIMEOUT = APP.config.get('JOB_TIMEOUT', 10 * 60)
 PROJECT_ID = APP.config['PROJECT_ID']
 
 # Configure logging
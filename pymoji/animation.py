@@ -0,0 +1,205 @@
+"""Animated GIF support: decodes every frame, tracks faces detected on a few
+keyframes across the frames in between, and re-encodes the result.
+
+Only keyframes are sent to the Vision API (all in one batch request); faces
+on the other frames are interpolated between matching detections on the
+surrounding keyframes.
+
+http://pillow.readthedocs.io/en/4.2.x/reference/ImageSequence.html
+http://pillow.readthedocs.io/en/4.2.x/handbook/image-file-formats.html#saving-sequences
+"""
+from PIL import Image, ImageSequence
+
+from pymoji import GIF_KEYFRAME_INTERVAL, GIF_MAX_PIXELS
+
+
+# frame duration in milliseconds for GIFs that don't say
+DEFAULT_FRAME_DURATION = 100
+
+
+def get_keyframes(frame_count, interval=GIF_KEYFRAME_INTERVAL):
+    """Picks which frames to run face detection on: every interval-th frame,
+    plus the last one so no frame is extrapolated.
+
+    Examples:
+        >>> get_keyframes(25, 10)
+        [0, 10, 20, 24]
+        >>> get_keyframes(1, 10)
+        [0]
+
+    Args:
+        frame_count: the number of frames in the animation
+        interval: frames between keyframes
+
+    Returns:
+        a sorted list of frame indices
+    """
+    keyframes = list(range(0, frame_count, max(interval, 1)))
+    if keyframes[-1] != frame_count - 1:
+        keyframes.append(frame_count - 1)
+    return keyframes
+
+
+def get_frame_step(frame_count, frame_pixels, max_pixels=GIF_MAX_PIXELS):
+    """Computes how many frames to merge into one so the decoded animation
+    stays within the given pixel budget.
+
+    Examples:
+        >>> get_frame_step(100, 500 * 500, 25 * 1000 * 1000)
+        1
+        >>> get_frame_step(1000, 500 * 500, 25 * 1000 * 1000)
+        10
+        >>> get_frame_step(3, 10 ** 9, 25 * 1000 * 1000)
+        3
+
+    Args:
+        frame_count: the number of frames in the animation
+        frame_pixels: pixels per frame
+        max_pixels: decoded pixels allowed across all frames, None to disable
+
+    Returns:
+        keep every step-th frame, from 1 up to frame_count (first frame only)
+    """
+    if not max_pixels:
+        return 1
+    return min(max(-(-frame_count * frame_pixels // max_pixels), 1), max(frame_count, 1))
+
+
+def read_frames(image, max_pixels=GIF_MAX_PIXELS):
+    """Decodes the frames of the given animated image. Animations bigger than
+    the pixel budget are subsampled: only every few frames are kept, each
+    showing for as long as the frames it stands in for, so the timing holds.
+
+    Args:
+        image: an animated PIL.Image, e.g. a GIF
+        max_pixels: decoded pixels allowed across all frames, see get_frame_step
+
+    Returns:
+        a 3-tuple of a list of RGB PIL.Image frames, a list of frame durations
+            in milliseconds, and the loop count (None if the image doesn't loop)
+    """
+    step = get_frame_step(getattr(image, 'n_frames', 1), image.width * image.height, max_pixels)
+    if step > 1:
+        print('Keeping every {} of {} frames'.format(step, image.n_frames))
+
+    frames = []
+    durations = []
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        duration = frame.info.get('duration', DEFAULT_FRAME_DURATION)
+        if index % step:
+            durations[-1] += duration
+            continue
+        durations.append(duration)
+        frames.append(frame.convert('RGB'))
+    return frames, durations, image.info.get('loop')
+
+
+def save_frames(frames, durations, loop, output_stream):
+    """Encodes the given frames as an animated GIF, keeping their durations
+    and the loop count. Each frame gets its own adaptive palette.
+
+    Args:
+        frames: a list of RGB PIL.Image frames
+        durations: a list of frame durations in milliseconds
+        loop: the loop count (0 loops forever), or None to play once
+        output_stream: a BufferedIO to write the GIF to
+    """
+    palette_frames = [frame.convert('P', palette=Image.ADAPTIVE) for frame in frames]
+    options = {
+        'format': 'GIF',
+        'save_all': True,
+        'append_images': palette_frames[1:],
+        'duration': durations,
+    }
+    if loop is not None:
+        options['loop'] = loop
+    palette_frames[0].save(output_stream, **options)
+
+
+def get_center(face):
+    """Returns the (x, y) center of the bounding box of the given face."""
+    (left, top, right, bottom) = face.box
+    return ((left + right) / 2.0, (top + bottom) / 2.0)
+
+
+def match_faces(faces_a, faces_b):
+    """Pairs up faces detected on two keyframes, greedily by closest center.
+    Faces that moved further than their own size are treated as different.
+
+    Args:
+        faces_a: a list of models.Face records on the earlier keyframe
+        faces_b: a list of models.Face records on the later keyframe
+
+    Returns:
+        a list of (index in faces_a, index in faces_b) pairs
+    """
+    candidates = []
+    for i, face_a in enumerate(faces_a):
+        (left, top, right, bottom) = face_a.box
+        max_distance = max(right - left, bottom - top)
+        (x_a, y_a) = get_center(face_a)
+        for j, face_b in enumerate(faces_b):
+            (x_b, y_b) = get_center(face_b)
+            distance = ((x_a - x_b) ** 2 + (y_a - y_b) ** 2) ** 0.5
+            if distance <= max_distance:
+                candidates.append((distance, i, j))
+
+    pairs = []
+    matched_a = set()
+    matched_b = set()
+    for (_, i, j) in sorted(candidates):
+        if i not in matched_a and j not in matched_b:
+            matched_a.add(i)
+            matched_b.add(j)
+            pairs.append((i, j))
+    return pairs
+
+
+def interpolate_face(face_a, face_b, weight):
+    """Returns a copy of the nearer of the given faces with its bounding box
+    moved the given fraction of the way from face_a to face_b.
+
+    Args:
+        face_a: a models.Face record on the earlier keyframe
+        face_b: the same face on the later keyframe
+        weight: a float from 0 (at face_a) to 1 (at face_b)
+
+    Returns:
+        a new models.Face record
+    """
+    face = face_a if weight < 0.5 else face_b
+    vertices = [(int(round(x_a + (x_b - x_a) * weight)), int(round(y_a + (y_b - y_a) * weight)))
+                for ((x_a, y_a), (x_b, y_b)) in zip(face_a.vertices, face_b.vertices)]
+    return face.moved(vertices)
+
+
+def track_faces(keyframes, keyframe_faces, frame_count):
+    """Fills in faces for every frame from the faces detected on keyframes.
+    Faces matched on both surrounding keyframes glide between them; the rest
+    stay put and show on the nearer half of the frames only.
+
+    Args:
+        keyframes: a sorted list of keyframe indices, see get_keyframes
+        keyframe_faces: a list of models.Face lists, one per keyframe
+        frame_count: the number of frames in the animation
+
+    Returns:
+        a list of models.Face lists, one per frame
+    """
+    frame_faces = [[] for _ in range(frame_count)]
+    for (start, faces_a), (end, faces_b) in zip(zip(keyframes, keyframe_faces),
+                                                zip(keyframes[1:], keyframe_faces[1:])):
+        pairs = match_faces(faces_a, faces_b)
+        matched_a = set(i for (i, _) in pairs)
+        matched_b = set(j for (_, j) in pairs)
+        unmatched_a = [face for i, face in enumerate(faces_a) if i not in matched_a]
+        unmatched_b = [face for j, face in enumerate(faces_b) if j not in matched_b]
+        for index in range(start, end):
+            weight = (index - start) / float(end - start)
+            faces = [interpolate_face(faces_a[i], faces_b[j], weight) for (i, j) in pairs]
+            faces.extend(unmatched_a if weight < 0.5 else unmatched_b)
+            frame_faces[index] = faces
+
+    # the last keyframe (or the only one) is as detected
+    frame_faces[keyframes[-1]] = list(keyframe_faces[-1])
+    return frame_faces
@@ -1,28 +1,118 @@
 """Hooks up the routes for the Emojivision web app."""
-from datetime import datetime
+from io import BytesIO
 import logging
 import os
 
-from flask import flash, redirect, render_template, request, send_from_directory, url_for
+from flask import (flash, g, jsonify, redirect, render_template, request, send_from_directory,
+  url_for)
 from google.cloud import error_reporting
 
-from pymoji import APP, PROJECT_ID
-from pymoji.constants import CLOUD_ROOT, DEMO_PATH, OUTPUT_DIR
-from pymoji.faces import process_cloud, process_local
-from pymoji.utils import (allowed_file, download_json, get_json_name, get_output_name,
-  load_json, report_upload_to_slack)
+from pymoji import APP, EMOJI_QUALITY, HTML_CACHE_SECONDS, PROJECT_ID
+from pymoji.constants import IMMUTABLE_CACHE_CONTROL, IMMUTABLE_PREFIXES, OUTPUT_DIR
+from pymoji.emoji import EMOJI_RESAMPLE, load_emoji_atlas
+from pymoji.faces import get_demo_run, process_image
+from pymoji.jobs import DONE, ERROR, LocalJobQueue, PENDING_STATUSES
+from pymoji.slack import SlackNotifier
+from pymoji.storage import GCSStorage, LocalStorage
+from pymoji.utils import (allowed_file, download_json, get_id_name, get_json_name,
+  get_output_name, load_json)
+
+
+# preload the bundled emoji so no request pays for it (once per gunicorn worker)
+load_emoji_atlas()
+
+# renderers the demo can be shown with
+RENDERERS = ('emoji', 'bounding_box')
+
+# storage backends, created on first use
+# key: APP.testing
+# value: storage.Storage
+STORAGE = {}
+
+# background face runs for uploads, with status shared through their storage
+# key: APP.testing
+# value: jobs.LocalJobQueue
+JOBS = {}
+
+# batched upload notifications, sent from a background thread
+SLACK = SlackNotifier()
+
+
+def get_storage():
+    """Returns where run artifacts live: the local static folder in testing,
+    else the cloud. Checked on every call, since APP.testing may be set after
+    import (e.g. by tests)."""
+    testing = bool(APP.testing)
+    if testing not in STORAGE:
+        STORAGE[testing] = LocalStorage() if testing else GCSStorage()
+    return STORAGE[testing]
+
+
+def get_job_queue():
+    """Returns the background job queue sharing status through get_storage."""
+    testing = bool(APP.testing)
+    if testing not in JOBS:
+        JOBS[testing] = LocalJobQueue(get_storage())
+    return JOBS[testing]
+
+
+# Cache-Control header values
+# key: cache policy name
+# value: Cache-Control header
+CACHE_POLICIES = {
+    'immutable': IMMUTABLE_CACHE_CONTROL, # generated artifacts, see IMMUTABLE_PREFIXES
+    'static': 'public, max-age=86400', # favicon and friends
+    'html': 'public, max-age={}'.format(HTML_CACHE_SECONDS), # finished results pages
+    'revalidate': 'no-cache', # may be stored, but check the ETag first
+    'none': 'no-store, no-cache, must-revalidate, max-age=0',
+}
+
+# default cache policy per route endpoint, anything else isn't cached
+# (views may override theirs by setting g.cache_policy)
+ENDPOINT_CACHE_POLICIES = {
+    'emojivision': 'html',
+    'index': 'revalidate', # flashed messages come and go
+    'favicon': 'static',
+    'robots_txt': 'static',
+}
+
+
+def get_cache_policy(response):
+    """Picks the cache policy name for the given response to the current request.
+
+    Args:
+        response: a Flask response
+
+    Returns:
+        a key of CACHE_POLICIES
+    """
+    if request.method not in ('GET', 'HEAD') or response.status_code not in (200, 304):
+        return 'none'
+    if 'cache_policy' in g:
+        return g.cache_policy
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename', '')
+        return 'immutable' if filename.startswith(IMMUTABLE_PREFIXES) else 'revalidate'
+    return ENDPOINT_CACHE_POLICIES.get(request.endpoint, 'none')
 
 
 @APP.after_request
 def after_request(response):
     """Standard Flask post-request hook."""
 
-    # Quick and dirty hack to wipe out caching for now
-    response.headers['Last-Modified'] = datetime.now()
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, '\
-        'pre-check=0, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '-1'
+    # Per-route caching, with ETags and conditional GETs (304) for pages.
+    # Static files get their ETags and 304s from Flask already.
+    policy = get_cache_policy(response)
+    response.headers['Cache-Control'] = CACHE_POLICIES[policy]
+    if policy == 'none':
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '-1'
+    else:
+        response.headers.pop('Expires', None) # leave it to max-age
+    if policy in ('html', 'revalidate') and response.status_code == 200 \
+            and not response.direct_passthrough:
+        response.add_etag()
+        response.make_conditional(request)
 
     # Security-related best practice headers
     response.headers.add('X-Frame-Options', 'DENY')
@@ -31,28 +121,25 @@ def after_request(response):
     return response
 
 
-@APP.route('/emojivision/')
-def emojivision_index():
-    """Launches a demo run and redirects to the results."""
-    with open(DEMO_PATH, 'rb') as image:
-        run_args = {
-            'image_stream': image,
-            'filename': 'demo.jpg',
-            'renderer': request.form.get('renderer', 'emoji')
-        }
-        print('Processing run: {}'.format(run_args))
-
-        id_filename = None
-        if APP.testing:
-            id_filename = process_local(**run_args)
-        else:
-            run_args['mime_type'] = 'image/jpeg'
-            id_filename = process_cloud(**run_args)
+def get_render_options():
+    """Returns the (renderer, quality) 2-tuple requested in the form, with the
+    defaults in place of unknown values, so made-up options can't mint runs
+    (and dedup entries) of their own."""
+    renderer = request.form.get('renderer', 'emoji')
+    if renderer not in RENDERERS:
+        renderer = 'emoji'
+    quality = request.form.get('quality', EMOJI_QUALITY)
+    if quality not in EMOJI_RESAMPLE:
+        quality = EMOJI_QUALITY
+    return renderer, quality
 
-        return redirect(url_for('emojivision', id_filename=id_filename))
 
-    # fallback on root index
-    return redirect(url_for('index'))
+@APP.route('/emojivision/')
+def emojivision_index():
+    """Redirects to the demo run results, rendering the demo only the first time."""
+    (renderer, quality) = get_render_options()
+    id_filename = get_demo_run(get_storage(), renderer, quality)
+    return redirect(url_for('emojivision', id_filename=id_filename))
 
 
 @APP.route('/emojivision/<id_filename>')
@@ -62,19 +149,28 @@ def emojivision(id_filename):
     Args:
         id_filename: a unique filename string
     """
-    kwargs = {} # data payload for template
+    kwargs = {'id_filename': id_filename} # data payload for template
+
+    job = get_job_queue().get_status(id_filename)
+    if job and job['status'] in PENDING_STATUSES:
+        # still running, so let the page poll until it's done
+        g.cache_policy = 'none'
+        kwargs['status_url'] = url_for('emojivision_status', id_filename=id_filename)
+        return render_template('result.html', **kwargs)
+    if job and job['status'] == DONE and job['id_filename'] != id_filename:
+        # deduplicated, the results live under an earlier run
+        return redirect(url_for('emojivision', id_filename=job['id_filename']))
+    if job and job['status'] == ERROR:
+        kwargs['job_error'] = job['error']
+        g.cache_policy = 'revalidate'
 
     output_filename = get_output_name(id_filename)
     json_filename = get_json_name(id_filename)
 
-    if APP.testing:
-        kwargs['input_image_url'] = url_for('static', filename='uploads/' + id_filename)
-        kwargs['output_image_url'] = url_for('static', filename='gen/' + output_filename)
-        kwargs['json_url'] = url_for('static', filename='gen/' + json_filename)
-    else:
-        kwargs['input_image_url'] = CLOUD_ROOT + PROJECT_ID + '/uploads/' + id_filename
-        kwargs['output_image_url'] = CLOUD_ROOT + PROJECT_ID + '/gen/' + output_filename
-        kwargs['json_url'] = CLOUD_ROOT + PROJECT_ID + '/gen/' + json_filename
+    storage = get_storage()
+    kwargs['input_image_url'] = storage.get_url('uploads/' + id_filename)
+    kwargs['output_image_url'] = storage.get_url('gen/' + output_filename)
+    kwargs['json_url'] = storage.get_url('gen/' + json_filename)
 
     # hidden mode for live debugging
     is_haxxx_mode = request.args.get('haxxx', APP.debug)
@@ -90,6 +186,23 @@ def emojivision(id_filename):
     return render_template('result.html', **kwargs)
 
 
+@APP.route('/emojivision/<id_filename>/status')
+def emojivision_status(id_filename):
+    """Serves the job status for the given ID-filename as JSON, for polling.
+    Runs that weren't made by a background job are reported as done.
+
+    Args:
+        id_filename: a unique filename string
+    """
+    job = get_job_queue().get_status(id_filename) or {
+        'job_id': id_filename,
+        'status': DONE,
+        'id_filename': id_filename,
+        'error': None,
+    }
+    return jsonify(job)
+
+
 @APP.route('/', methods=['GET', 'POST'])
 def index():
     """Serves the upload form index page. Sucessful submissions redirect to the
@@ -107,23 +220,27 @@ def index():
 
         # handle valid files
         if image and allowed_file(image.filename):
+            id_filename = get_id_name(image.filename)
+            (renderer, quality) = get_render_options()
             run_args = {
-                'image_stream': image,
+                # the upload stream closes with the request, so keep the bytes
+                'image_stream': BytesIO(image.read()),
                 'filename': image.filename,
-                'renderer': request.form.get('renderer', 'emoji')
+                'mime_type': image.content_type,
+                'renderer': renderer,
+                'quality': quality,
+                'id_filename': id_filename
             }
-            print('Processing run: {}'.format(run_args))
-
-            id_filename = None
-            if APP.testing:
-                id_filename = process_local(**run_args)
-            else:
-                run_args['mime_type'] = image.content_type
-                id_filename = process_cloud(**run_args)
+            print('Enqueueing run: {}'.format(run_args))
 
-                # Report the upload to slack, non-blocking
-                webhook_status = report_upload_to_slack(id_filename)
-                print('Status of webhook: %s' % webhook_status)
+            # process in the background and redirect right away
+            get_job_queue().submit(id_filename, process_image, storage=get_storage(),
+                                     **run_args)
+            if not APP.testing:
+                # Report the upload to slack in the next digest, non-blocking
+                if not SLACK.notify(id_filename):
+                    print('Slack queue full, dropped notification ({} so far)'.format(
+                        SLACK.stats['dropped']))
 
             return redirect(url_for('emojivision', id_filename=id_filename))
 
@@ -136,6 +253,7 @@ def index():
     is_haxxx_mode = request.args.get('haxxx', APP.debug)
     if is_haxxx_mode:
         kwargs['is_haxxx_mode'] = is_haxxx_mode
+        kwargs['default_quality'] = EMOJI_QUALITY
 
     id_filename = request.args.get('id_filename', '')
     if id_filename:
@@ -0,0 +1,250 @@
+"""Size-bounded caches for expensive, immutable results.
+
+https://docs.python.org/3/library/collections.html#collections.OrderedDict
+https://docs.python.org/3/library/hashlib.html
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+def get_content_key(content, *params):
+    """Makes a content-addressed cache key from the given bytes plus any
+    parameters that change what gets computed from them.
+
+    Examples:
+        >>> get_content_key(b'face', 'FACE_DETECTION', 20)[:16]
+        '85831f823816ac1d'
+
+    Args:
+        content: a bytes-like object, e.g. the raw image bytes
+        params: extra values that are part of the key
+
+    Returns:
+        a hex digest string
+    """
+    digest = hashlib.sha256(content)
+    for param in params:
+        digest.update('|{}'.format(param).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class LRUCache(object):
+    """Thread-safe in-memory least-recently-used cache bounded by the total
+    size of its values, e.g. in bytes. Values can optionally expire after a
+    time-to-live.
+
+    Examples:
+        >>> cache = LRUCache(max_size=4)
+        >>> cache.put('a', b'12')
+        >>> cache.put('b', b'34')
+        >>> cache.get('a')
+        b'12'
+        >>> cache.put('c', b'56')
+        >>> cache.get('b') is None
+        True
+        >>> cache.stats['evictions']
+        1
+    """
+
+    def __init__(self, max_size, sizeof=len, ttl=None, clock=time.monotonic):
+        """
+        Args:
+            max_size: maximum total size of all cached values
+            sizeof: a function(value) returning the size of a cached value
+            ttl: optional seconds after which a cached value expires
+            clock: a function() returning the current time in seconds
+        """
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+        self._items = OrderedDict() # key: cache key, value: (value, size, expiry time)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Returns the cached value for the given key, or the default."""
+        with self._lock:
+            if key not in self._items:
+                self.stats['misses'] += 1
+                return default
+            (value, size, expires) = self._items[key]
+            if expires is not None and expires <= self.clock():
+                del self._items[key]
+                self.size -= size
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return default
+            self._items.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        """Caches the given value, evicting least recently used values as
+        necessary. Values bigger than the whole cache are not stored."""
+        size = self.sizeof(value)
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._items[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size, _) = self._items.popitem(last=False)
+                self.size -= evicted_size
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        """Empties the cache (stats are kept)."""
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class DiskCache(object):
+    """Directory of cached byte strings, one file per key, bounded by total
+    size on disk. Evicts the least recently used files (by mtime) first.
+
+    Safe to share between processes: writes are atomic renames and a missing
+    file is just a miss.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+        Args:
+            directory: path to the cache directory, created on first put
+            max_bytes: maximum total size of all cached files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.size = 0
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _prepare(self):
+        """Creates the cache directory and counts what's already in it, once.
+        Call with the lock held."""
+        if not self._ready:
+            os.makedirs(self.directory, exist_ok=True)
+            self.size = sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                            if entry.is_file())
+            self._ready = True
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Returns the cached bytes for the given key, or None."""
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                data = cache_file.read()
+            os.utime(path) # mark as recently used
+        except (IOError, OSError):
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        with self._lock:
+            self.stats['hits'] += 1
+        return data
+
+    def put(self, key, data):
+        """Caches the given bytes, evicting least recently used files as
+        necessary."""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._prepare()
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(data)
+        path = self._get_path(key)
+        try:
+            replaced_size = os.stat(path).st_size
+        except OSError:
+            replaced_size = 0
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self.size += len(data) - replaced_size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Deletes the oldest files until the cache fits in max_bytes. Rescans
+        the directory since other processes may share it."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.tmp-'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        self.size = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue # already evicted by someone else
+            self.size -= size
+            self.stats['evictions'] += 1
+
+
+class TieredCache(object):
+    """Two-tier cache of byte strings: an in-memory LRU in front of an
+    optional on-disk tier. Disk hits are promoted into memory.
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        """
+        Args:
+            memory_bytes: size limit of the in-memory tier
+            disk_dir: optional directory for the on-disk tier
+            disk_bytes: size limit of the on-disk tier
+        """
+        self.memory = LRUCache(memory_bytes)
+        self.disk = DiskCache(disk_dir, disk_bytes) if disk_dir else None
+
+    def get(self, key):
+        """Returns the cached bytes for the given key, or None."""
+        data = self.memory.get(key)
+        if data is None and self.disk:
+            data = self.disk.get(key)
+            if data is not None:
+                self.memory.put(key, data)
+        return data
+
+    def put(self, key, data):
+        """Caches the given bytes in every tier."""
+        self.memory.put(key, data)
+        if self.disk:
+            self.disk.put(key, data)
+
+    def get_stats(self):
+        """Returns hit/miss/eviction counters and sizes for every tier.
+
+        Returns:
+            a dict of counters, e.g. {'memory_hits': 3, 'disk_hits': 1, ...}
+        """
+        stats = {}
+        tiers = [('memory', self.memory)]
+        if self.disk:
+            tiers.append(('disk', self.disk))
+        for name, tier in tiers:
+            for counter, value in tier.stats.items():
+                stats['{}_{}'.format(name, counter)] = value
+            stats['{}_bytes'.format(name)] = tier.size
+        return stats
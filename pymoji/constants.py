@@ -8,10 +8,17 @@ STATIC_DIR = os.path.join(PACKAGE_DIR, 'static')
 UPLOADS_DIR = os.path.join(STATIC_DIR, 'uploads')
 DEMO_PATH = os.path.join(UPLOADS_DIR, 'face-input.jpg')
 OUTPUT_DIR = os.path.join(STATIC_DIR, 'gen')
+EMOJI_DIR = os.path.join(STATIC_DIR, 'emoji')
+EMOJI_ATLAS_PATH = os.path.join(EMOJI_DIR, 'atlas.png')
+EMOJI_ATLAS_INDEX_PATH = os.path.join(EMOJI_DIR, 'atlas.json')
 
 # Supported image files (Google Vision and pillow)
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
 
+# Google Vision API maximum number of images per batch annotate request
+# https://cloud.google.com/vision/quotas
+VISION_BATCH_LIMIT = 16
+
 # Google Vision Likelihood
 # https://cloud.google.com/vision/docs/reference/rest/v1/images/annotate#likelihood
 UNKNOWN = 0
@@ -22,11 +29,21 @@ LIKELY = 4
 VERY_LIKELY = 5
 
 EMOJI_CDN_PATH = 'https://cdn.jsdelivr.net/emojione/assets/3.1/png/128/'
+EMOJI_SIZE = 128 # CDN source files are 128x128 PNGs
 # backup path: 'https://api.emojione.com/emoji/1f62d/download/128/'
 
+# Bump whenever a change to the rendering code changes how outputs look, so the
+# dedup index stops serving runs drawn by older code (see emoji.get_render_version)
+RENDER_VERSION = 1
+
 # Google Cloud Storage
 CLOUD_ROOT = 'http://storage.googleapis.com/'
 
+# Run artifacts are keyed by ID-filename and never change once written, so
+# browsers and CDNs may keep them for good. Other paths (e.g. job status) may.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+IMMUTABLE_PREFIXES = ('gen/', 'uploads/')
+
 # Slackhook info
 PYMOJI_WEBHOOK_USERNAME = 'pymoji_webhook'
 PYMOJI_WEBHOOK_ICON = ':pymoji_bot:'
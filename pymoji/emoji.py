@@ -4,15 +4,23 @@ http://pillow.readthedocs.io/en/4.2.x/reference/Image.html
 https://www.emojione.com/emoji/v3
 http://unicode.org/emoji/charts/full-emoji-list.html
 """
-from tempfile import TemporaryFile
+from io import BytesIO
+from itertools import product
+import json
+from operator import attrgetter
+import os
+import threading
 
 from PIL import Image, ImageDraw
 
-from pymoji import FACE_PAD, USE_GVA_LABELS
-from pymoji.constants import EMOJI_CDN_PATH
-from pymoji.constants import UNLIKELY, POSSIBLE, LIKELY, VERY_LIKELY
+from pymoji import (EMOJI_CACHE_BYTES, EMOJI_CDN_FALLBACK, EMOJI_QUALITY, EMOJI_RULES,
+    EMOJI_SIZE_BUCKET, FACE_PAD, USE_GVA_LABELS)
+from pymoji.cache import get_content_key, LRUCache
+from pymoji.constants import EMOJI_ATLAS_INDEX_PATH, EMOJI_ATLAS_PATH, EMOJI_CDN_PATH, EMOJI_SIZE, \
+    RENDER_VERSION
+from pymoji.constants import UNKNOWN, UNLIKELY, POSSIBLE, LIKELY, VERY_LIKELY
 from pymoji.utils import download_image
-from pymoji.vision import detect_labels, to_vision_image
+from pymoji.vision import detect_labels_batch, to_vision_image
 
 
 # dictionary object to use as in-memory cache of emoji images
@@ -20,6 +28,28 @@ from pymoji.vision import detect_labels, to_vision_image
 # value: 128x128 RGBA PIL.Image
 EMOJI = {} # cache
 
+# power-of-two mipmap resolutions of each emoji, built on first use (source
+# files are 128px)
+MIPMAP_SIZES = (16, 32, 64, 128, 256, 512)
+
+# renderer quality options for the final resize from the nearest mipmap level
+# key: quality name
+# value: PIL resampling filter
+EMOJI_RESAMPLE = {
+    'fast': Image.NEAREST,
+    'balanced': Image.BILINEAR,
+    'best': Image.LANCZOS,
+}
+
+# bounded LRU cache of resized emoji images and their mipmap levels
+# key: (emoji code string, width, height, quality) or (emoji code string, size)
+# value: RGBA PIL.Image of that size
+RESIZED_EMOJI = LRUCache(EMOJI_CACHE_BYTES, sizeof=lambda image: image.width * image.height * 4)
+
+# guards the one-time load of the bundled emoji atlas into EMOJI
+ATLAS_LOCK = threading.Lock()
+ATLAS_STATE = {'loaded': False, 'warned': False}
+
 DEFAULT_CODE = "1f642" # slightly smiling face
 
 SORROW_MAP = {
@@ -108,6 +138,193 @@ HUMOR_RANK = [
 ]
 
 
+# the emoji selection rules, see EmojiTable. Override any of these keys with
+# the EMOJI_RULES config setting to tune the mapping without code changes.
+DEFAULT_EMOJI_RULES = {
+    # key: likelihood, value: candidate emoji code
+    'sorrow': SORROW_MAP,
+    'anger': ANGER_MAP,
+    'surprise': SURPRISE_MAP,
+    'joy': JOY_MAP,
+    'headwear': {
+        LIKELY: "1f920", # cowboy hat face
+        VERY_LIKELY: "1f920",
+    },
+    # candidates for head labels (see get_head_labels), whole descriptions
+    # first, then the first matching keyword
+    'label_names': {
+        "tongue": "1f61b", # tongue sticking out
+        "sunglasses": "1f60e", # smiling face with sunglasses
+        "glasses": "1f913", # nerd face
+    },
+    'label_keywords': [
+        ("vision", "1f913"), # nerd face also; nerds have vision care
+        ("love", "1f60d"), # add more love love love
+        ("kiss", "1f60d"), # because kissyface
+    ],
+    'humor_rank': HUMOR_RANK,
+    'default': DEFAULT_CODE,
+}
+
+# the likelihood fields a table index is built from, in order
+LIKELIHOOD_FIELDS = ('sorrow', 'anger', 'surprise', 'joy', 'headwear')
+LIKELIHOOD_COUNT = VERY_LIKELY + 1
+
+
+def get_likelihood_index(sorrow, anger, surprise, joy, headwear):
+    """Computes the EmojiTable index of the given likelihoods. Values outside
+    the Google Vision Likelihood enum count as UNKNOWN.
+
+    Examples:
+        >>> get_likelihood_index(0, 0, 0, 0, 0)
+        0
+        >>> get_likelihood_index(0, 0, 0, 0, 5)
+        5
+        >>> get_likelihood_index(1, 0, 0, 0, 0)
+        1296
+        >>> get_likelihood_index(5, 5, 5, 5, 5) == LIKELIHOOD_COUNT ** 5 - 1
+        True
+
+    Returns:
+        an integer from 0 to LIKELIHOOD_COUNT ** 5 - 1
+    """
+    index = 0
+    for value in (sorrow, anger, surprise, joy, headwear):
+        if not 0 <= value < LIKELIHOOD_COUNT:
+            value = UNKNOWN
+        index = index * LIKELIHOOD_COUNT + value
+    return index
+
+
+class EmojiTable(object):
+    """Emoji selection rules compiled into lookup tables, so picking the emoji
+    for a face is a couple of list lookups instead of building and sorting a
+    candidate set.
+
+    The likelihood rules become one entry per (sorrow, anger, surprise, joy,
+    headwear) combination, 6^5 in all, each holding the funniest candidate
+    and its humor rank. Every distinct label emoji gets a bit; the labels of a
+    face fold into a bitmask, and a second small table holds the funniest
+    emoji for each mask. A label emoji wins if it ranks above the likelihood
+    winner.
+    """
+
+    def __init__(self, rules=None):
+        """
+        Args:
+            rules: a dict overriding any keys of DEFAULT_EMOJI_RULES
+
+        Raises:
+            ValueError if a candidate emoji is missing from the humor rank
+        """
+        self.rules = dict(DEFAULT_EMOJI_RULES)
+        self.rules.update(rules or {})
+        # identifies the effective rules, e.g. in dedup keys
+        self.rules_key = get_content_key(json.dumps(self.rules, sort_keys=True).encode('utf-8'))
+        self.humor_rank = list(self.rules['humor_rank'])
+        self.ranks = {code: rank for (rank, code) in enumerate(self.humor_rank)}
+
+        maps = []
+        for field in LIKELIHOOD_FIELDS:
+            likelihood_map = {int(likelihood): code
+                              for (likelihood, code) in self.rules[field].items()}
+            for code in likelihood_map.values():
+                self._check(code)
+            maps.append(likelihood_map)
+        headwear_map = maps.pop()
+        default = self.rules['default']
+        self._check(default)
+
+        # likelihood table, product() counts up in get_likelihood_index order
+        self.codes = []
+        self.code_ranks = []
+        for likelihoods in product(range(LIKELIHOOD_COUNT), repeat=len(LIKELIHOOD_FIELDS)):
+            candidates = [likelihood_map.get(likelihood, default)
+                          for (likelihood_map, likelihood) in zip(maps, likelihoods)]
+            if likelihoods[-1] in headwear_map:
+                candidates.append(headwear_map[likelihoods[-1]])
+            code = min(candidates, key=self.ranks.get)
+            self.codes.append(code)
+            self.code_ranks.append(self.ranks[code])
+
+        # label bitmask table
+        label_codes = sorted(set(list(self.rules['label_names'].values()) +
+                                 [code for (_, code) in self.rules['label_keywords']]),
+                             key=self._check)
+        self.label_bits = {code: 1 << bit for (bit, code) in enumerate(label_codes)}
+        self.mask_codes = [None]
+        self.mask_ranks = [len(self.humor_rank)]
+        for mask in range(1, 1 << len(label_codes)):
+            # codes are in rank order, so the lowest set bit is the funniest
+            code = label_codes[(mask & -mask).bit_length() - 1]
+            self.mask_codes.append(code)
+            self.mask_ranks.append(self.ranks[code])
+        self._description_bits = {} # memo, key: label description, value: bit
+
+    def _check(self, code):
+        """Returns the humor rank of the given candidate emoji code."""
+        if code not in self.ranks:
+            raise ValueError('emoji {} is missing from the humor rank'.format(code))
+        return self.ranks[code]
+
+    def get_label_bit(self, description):
+        """Returns the bitmask bit of the emoji for the given label
+        description, or 0 if no rule matches."""
+        bit = self._description_bits.get(description)
+        if bit is None:
+            code = self.rules['label_names'].get(description)
+            if code is None:
+                code = next((code for (keyword, code) in self.rules['label_keywords']
+                             if keyword in description), None)
+            bit = self.label_bits.get(code, 0)
+            self._description_bits[description] = bit
+        return bit
+
+    def lookup(self, face, labels=()):
+        """Picks the funniest emoji for the given face and head labels.
+
+        Args:
+            face: a models.Face record, or anything with the same likelihood
+                attributes (e.g. a Google Vision API face annotation)
+            labels: optional label annotations for the face's head
+
+        Returns:
+            an emoji string code
+        """
+        index = get_likelihood_index(face.sorrow_likelihood, face.anger_likelihood,
+                                     face.surprise_likelihood, face.joy_likelihood,
+                                     face.headwear_likelihood)
+        mask = 0
+        for label in labels:
+            mask |= self.get_label_bit(label.description)
+        if mask and self.mask_ranks[mask] < self.code_ranks[index]:
+            return self.mask_codes[mask]
+        return self.codes[index]
+
+
+# the active emoji selection rules
+EMOJI_TABLE = EmojiTable(EMOJI_RULES)
+
+
+def get_render_version(table=EMOJI_TABLE, use_gva_labels=USE_GVA_LABELS):
+    """Returns a short string identifying everything besides the upload and
+    the run options that decides what an emoji run looks like: the rendering
+    code's RENDER_VERSION, the effective emoji rules and label analysis.
+
+    Examples:
+        >>> get_render_version(EmojiTable(), use_gva_labels=False)[:2]
+        '1.'
+
+    Args:
+        table: the EmojiTable in use
+        use_gva_labels: whether or not heads get label analysis
+
+    Returns:
+        a version string
+    """
+    return '{}.{}.{}'.format(RENDER_VERSION, table.rules_key[:12], int(use_gva_labels))
+
+
 def get_humor_rank(code):
     """Computes a humor ranking value for the given emoji code. A lower rank
     roughly means a funnier or rarer emoji.
@@ -118,7 +335,7 @@ def get_humor_rank(code):
     Returns:
         an integer humor rank, lower is better
     """
-    return HUMOR_RANK.index(code)
+    return EMOJI_TABLE.ranks[code]
 
 
 def get_face_box(face):
@@ -127,21 +344,13 @@ def get_face_box(face):
     Remember that the upper-left corner is the origin!
 
     Args:
-        face: a face annotation object from the Google Vision API.
+        face: a models.Face record, see codec.to_faces
 
     Returns:
         a 4-tuple defining the left, upper, right, and lower pixel of the face
         bounding-box
     """
-    face_top_left = face.bounding_poly.vertices[0]
-    face_left = face_top_left.x
-    face_top = face_top_left.y
-
-    face_bottom_right = face.bounding_poly.vertices[2]
-    face_right = face_bottom_right.x
-    face_bottom = face_bottom_right.y
-
-    return (face_left, face_top, face_right, face_bottom)
+    return face.box
 
 
 def get_depth_rank(face):
@@ -154,13 +363,12 @@ def get_depth_rank(face):
     Note: initial tests using area as a proxy for depth yielded unstable results.
 
     Args:
-        face: a face annotation object from the Google Vision API.
+        face: a models.Face record, see codec.to_faces
 
     Returns:
-        a float value roughly approximating depth
+        a float value roughly approximating depth, precomputed per record
     """
-    (_face_left, face_top, _face_right, _face_bottom) = get_face_box(face)
-    return face_top
+    return face.depth
 
 
 def get_emoji_box(face, face_pad=FACE_PAD, code=None):
@@ -169,14 +377,14 @@ def get_emoji_box(face, face_pad=FACE_PAD, code=None):
     annotation metadata. Remember that the upper-left corner is the origin!
 
     Args:
-        face: a face annotation object from the Google Vision API.
+        face: a models.Face record
         face_pad: percentage to enlarge emoji beyond face bounding box
 
     Returns:
         a 4-tuple defining the left, upper, right, and lower pixel coordinate
             e.g. (0, 0, 128, 128)
     """
-    (face_left, face_top, face_right, face_bottom) = get_face_box(face)
+    (face_left, face_top, face_right, face_bottom) = face.box
 
     # compute height and width (top-left corner is origin)
     face_height = face_bottom - face_top
@@ -199,147 +407,332 @@ def get_emoji_box(face, face_pad=FACE_PAD, code=None):
     return (left, top, right, bottom)
 
 
-def get_emoji_image(code, box):
-    """Creates an emoji RGBA PIL.Image for the given code, scaled to the
-    given bounding box. Maintains a cache of original templates (CDN source
-    files are 128x128 PNGs).
+def build_emoji_atlas(codes, atlas_path=EMOJI_ATLAS_PATH,
+                      index_path=EMOJI_ATLAS_INDEX_PATH, source_dir=None):
+    """Downloads the given emoji from the CDN once (or reads them from a local
+    copy of the same PNG assets) and packs them into a single sprite sheet PNG
+    plus a JSON index, so the app never needs the CDN at runtime. See the
+    buildemoji command in manage.py.
+
+    The sheet is a grid of EMOJI_SIZE cells; the index lists the codes in
+    cell order (left to right, top to bottom).
+
+    Args:
+        codes: a list of emoji code strings
+        atlas_path: destination path of the sprite sheet PNG
+        index_path: destination path of the JSON index
+        source_dir: optional directory of <code>.png files to use instead of the CDN
+    """
+    columns = 8
+    rows = (len(codes) + columns - 1) // columns
+    atlas = Image.new('RGBA', (columns * EMOJI_SIZE, rows * EMOJI_SIZE))
+    for cell, code in enumerate(codes):
+        if source_dir:
+            emoji = Image.open(os.path.join(source_dir, code + '.png')).convert('RGBA')
+        else:
+            emoji = download_image(EMOJI_CDN_PATH + code + '.png').convert('RGBA')
+        if emoji.size != (EMOJI_SIZE, EMOJI_SIZE):
+            emoji = emoji.resize((EMOJI_SIZE, EMOJI_SIZE), Image.LANCZOS)
+        (row, column) = divmod(cell, columns)
+        atlas.paste(emoji, (column * EMOJI_SIZE, row * EMOJI_SIZE))
+
+    atlas_dir = os.path.dirname(atlas_path)
+    if atlas_dir and not os.path.exists(atlas_dir):
+        os.makedirs(atlas_dir)
+    atlas.save(atlas_path, format='PNG', optimize=True)
+    with open(index_path, 'w') as index_file:
+        json.dump({'size': EMOJI_SIZE, 'columns': columns, 'codes': codes}, index_file, indent=2)
+    print('Saved {} emoji to {}'.format(len(codes), atlas_path))
+
+
+def load_emoji_atlas(atlas_path=EMOJI_ATLAS_PATH, index_path=EMOJI_ATLAS_INDEX_PATH):
+    """Loads every emoji in the bundled sprite sheet into the EMOJI cache.
+    Only the first successful call does any work; safe to call from multiple
+    threads. Called at app startup, and on first use otherwise.
+
+    Args:
+        atlas_path: path of the sprite sheet PNG
+        index_path: path of the JSON index
+
+    Returns:
+        the number of emoji in the EMOJI cache
+    """
+    with ATLAS_LOCK:
+        if ATLAS_STATE['loaded']:
+            return len(EMOJI)
+
+        if not (os.path.isfile(atlas_path) and os.path.isfile(index_path)):
+            if not ATLAS_STATE['warned']:
+                ATLAS_STATE['warned'] = True
+                print('No emoji atlas found at {}, run buildemoji'.format(atlas_path))
+            return len(EMOJI)
+
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        size = index['size']
+        columns = index['columns']
+        with Image.open(atlas_path) as atlas:
+            atlas = atlas.convert('RGBA')
+            for cell, code in enumerate(index['codes']):
+                (row, column) = divmod(cell, columns)
+                left = column * size
+                top = row * size
+                EMOJI.setdefault(code, atlas.crop((left, top, left + size, top + size)))
+        ATLAS_STATE['loaded'] = True
+
+        print('Loaded {} emoji from {}'.format(len(index['codes']), atlas_path))
+        return len(EMOJI)
+
+
+def get_emoji_template(code, use_cdn=EMOJI_CDN_FALLBACK):
+    """Returns the original 128x128 RGBA PIL.Image for the given code from the
+    EMOJI cache, loading the bundled atlas on first use. Emoji missing from the
+    atlas are optionally downloaded from the CDN.
 
     Args:
         code: a string containing the code for the desired emoji.
-        box: a 4-tuple defining the emoji bounding box (see get_emoji_box)
+        use_cdn: whether or not to fallback on the emojione CDN
 
     Returns:
-        a scaled RGBA PIL.Image of the emoji.
+        an RGBA PIL.Image of the emoji.
+
+    Raises:
+        KeyError if the emoji isn't bundled and the CDN fallback is off
     """
     if code not in EMOJI:
-        # handle cache miss
+        load_emoji_atlas()
+
+    if code not in EMOJI:
+        if not use_cdn:
+            raise KeyError('emoji {} is not in the atlas, run buildemoji'.format(code))
+        # handle cache miss, downloading outside the lock
         emoji_url = EMOJI_CDN_PATH + code + '.png'
-        emoji = download_image(emoji_url).convert('RGBA')
-        EMOJI[code] = emoji
+        template = download_image(emoji_url).convert('RGBA')
+        with ATLAS_LOCK:
+            return EMOJI.setdefault(code, template)
 
-    # compute height and width (top-left corner is origin)
+    return EMOJI[code]
+
+
+def get_emoji_size(box, bucket=EMOJI_SIZE_BUCKET):
+    """Computes the emoji image size for the given bounding box, optionally
+    rounded up to a multiple of bucket pixels so similar boxes share a cached
+    image.
+
+    Examples:
+        >>> get_emoji_size((10, 10, 110, 60), bucket=0)
+        (100, 50)
+        >>> get_emoji_size((10, 10, 110, 60), bucket=8)
+        (104, 56)
+
+    Args:
+        box: a 4-tuple defining the emoji bounding box (see get_emoji_box)
+        bucket: size quantum in pixels, 0 or None to disable
+
+    Returns:
+        a (width, height) tuple
+    """
     (left, top, right, bottom) = box
-    height = bottom - top
-    width = right - left
+    width = max(right - left, 1)
+    height = max(bottom - top, 1)
+    if bucket and bucket > 1:
+        width = -(-width // bucket) * bucket
+        height = -(-height // bucket) * bucket
+    return (width, height)
+
+
+def get_mipmap_size(width, height):
+    """Picks the smallest mipmap resolution that is at least as big as the
+    requested size, or the biggest one available.
+
+    Examples:
+        >>> get_mipmap_size(100, 50)
+        128
+        >>> get_mipmap_size(1000, 900)
+        512
+    """
+    target = max(width, height)
+    for size in MIPMAP_SIZES:
+        if size >= target:
+            return size
+    return MIPMAP_SIZES[-1]
 
-    # get image from cache and resize
-    return EMOJI[code].resize((width, height), resample=0)
 
+def get_mipmap(code, width, height):
+    """Returns the mipmap level of the given emoji for the requested size, see
+    get_mipmap_size. Each level is resampled with LANCZOS once, so per-face
+    resizes start from a level close to the target size. Levels share the
+    byte-bounded RESIZED_EMOJI cache, so rarely used ones get evicted.
 
-def get_emoji_code(image, face, use_gva_labels=USE_GVA_LABELS):
-    """Computes the 'best' emoji string code for the given face in the given
-    image.
+    Args:
+        code: a string containing the code for the desired emoji.
+        width: target width in pixels
+        height: target height in pixels
+
+    Returns:
+        an RGBA PIL.Image
+    """
+    size = get_mipmap_size(width, height)
+    template = get_emoji_template(code)
+    if template.size == (size, size):
+        return template # already kept in EMOJI
+    key = (code, size)
+    level = RESIZED_EMOJI.get(key)
+    if level is None:
+        level = template.resize((size, size), Image.LANCZOS)
+        RESIZED_EMOJI.put(key, level)
+    return level
+
+
+def get_emoji_image(code, box, quality=EMOJI_QUALITY):
+    """Creates an emoji RGBA PIL.Image for the given code, scaled to the
+    given bounding box (or the nearest size bucket, see get_emoji_size).
+    Starts from the nearest mipmap level, then does a final resize with the
+    resampling filter for the given quality. Resized images are kept in the
+    bounded RESIZED_EMOJI cache.
 
     Args:
-        image: the original PIL.Image containing the face
-        face: a face annotation object from the Google Vision API.
-        use_gva_labels: fallback on Google Vision API label analysis (slow)
+        code: a string containing the code for the desired emoji.
+        box: a 4-tuple defining the emoji bounding box (see get_emoji_box)
+        quality: one of EMOJI_RESAMPLE, trades speed for smoothness
 
     Returns:
-        an emoji string code
+        a scaled RGBA PIL.Image of the emoji.
     """
-    sorrow_code = SORROW_MAP.get(face.sorrow_likelihood, DEFAULT_CODE)
-    anger_code = ANGER_MAP.get(face.anger_likelihood, DEFAULT_CODE)
-    surprise_code = SURPRISE_MAP.get(face.surprise_likelihood, DEFAULT_CODE)
-    joy_code = JOY_MAP.get(face.joy_likelihood, DEFAULT_CODE)
+    if quality not in EMOJI_RESAMPLE:
+        quality = EMOJI_QUALITY
+    (width, height) = get_emoji_size(box)
+    key = (code, width, height, quality)
+    emoji = RESIZED_EMOJI.get(key)
+    if emoji is None:
+        mipmap = get_mipmap(code, width, height)
+        emoji = mipmap.resize((width, height), resample=EMOJI_RESAMPLE[quality])
+        RESIZED_EMOJI.put(key, emoji)
+    return emoji
 
-    candidates = set([sorrow_code, anger_code, surprise_code, joy_code])
 
-    if face.headwear_likelihood > POSSIBLE:
-        candidates.add("1f920") # cowboy hat face
+def get_emoji_cache_stats():
+    """Returns hit/miss/eviction counters and sizes of the emoji caches.
 
-    if use_gva_labels:
-        # USE_GVA_LABELS - analyze labels on individual head
-        # (((  AKA USE_BIG_GUNS )))
+    Returns:
+        a dict of counters, e.g. {'hits': 10, 'misses': 2, ...}
+    """
+    stats = dict(RESIZED_EMOJI.stats)
+    stats['bytes'] = RESIZED_EMOJI.size
+    stats['resized'] = len(RESIZED_EMOJI)
+    stats['originals'] = len(EMOJI)
+    return stats
+
+
+def get_head_labels(image, faces):
+    """Crops the head of every given face out of the given image and submits
+    them all to Google Vision label detection in one batched request.
+
+    Args:
+        image: the original PIL.Image containing the faces
+        faces: a list of models.Face records
 
-        # crop head + save into temp file
-        head_box = get_emoji_box(face)
-        head_image = image.crop(head_box)
-        with TemporaryFile() as head_stream:
+    Returns:
+        a list of Label annotation lists, one per face
+    """
+    gv_head_images = []
+    for face in faces:
+        head_image = image.crop(get_emoji_box(face))
+        if head_image.mode != 'RGB':
+            head_image = head_image.convert('RGB') # JPEG has no alpha
+        with BytesIO() as head_stream:
             head_image.save(head_stream, format='JPEG')
             head_stream.seek(0)
+            gv_head_images.append(to_vision_image(input_stream=head_stream))
 
-            # submit head image for labels
-            gv_head_image = to_vision_image(input_stream=head_stream)
-            labels = detect_labels(gv_head_image)
-
-            # Check labels (len <= MAX_RESULTS) and add them to candidates.
-            # Control which label wins through HUMOR_RANK.
-            for label in labels:
-                if label.description == "tongue":
-                    candidates.add("1f61b") # tongue sticking out
-                elif label.description == "sunglasses":
-                    candidates.add("1f60e") # smiling face with sunglasses
-                elif label.description == "glasses":
-                    candidates.add("1f913") # nerd face
-                elif 'vision' in label.description:
-                    candidates.add("1f913") # nerd face also; nerds have vision care
-                elif 'love' in label.description:
-                    candidates.add("1f60d") # add more love love love
-                elif 'kiss' in label.description:
-                    candidates.add("1f60d") # because kissyface
-
-    # sort by humor rank and return the funniest
-    ranked_candidates = sorted(candidates, key=get_humor_rank)
-    return ranked_candidates[0]
-
-
-def render_emoji(image, face):
-    """Renders an emoji on top of the given image using the given face
-    annotation data.
+    return detect_labels_batch(gv_head_images)
+
+
+def get_emoji_code(face, labels=()):
+    """Computes the 'best' emoji string code for the given face, see
+    EmojiTable.
+
+    Args:
+        face: a models.Face record, or anything with the same likelihood
+            attributes (e.g. a Google Vision API face annotation)
+        labels: optional label annotations for the face's head, see get_head_labels
+
+    Returns:
+        an emoji string code
+    """
+    return EMOJI_TABLE.lookup(face, labels)
+
+
+def place_emoji(face, labels=(), quality=EMOJI_QUALITY):
+    """Picks, scales and positions the emoji for the given face annotation
+    data, without drawing anything.
 
     https://googlecloudplatform.github.io/google-cloud-python/latest/vision/gapic/v1/types.html#google.cloud.vision_v1.types.AnnotateImageResponse
 
     Args:
-        image: a PIL.Image
-        face: a face annotation object from the Google Vision API.
+        face: a models.Face record
+        labels: optional label annotations for the face's head
+        quality: emoji resampling quality, see EMOJI_RESAMPLE
+
+    Returns:
+        a 2-tuple of the scaled RGBA PIL.Image and its (left, top) position
     """
-    code = get_emoji_code(image, face)
-    box = get_emoji_box(face, code=code)
-    emoji = get_emoji_image(code, box)
-    mask = emoji
-    image.paste(emoji, box, mask)
+    code = get_emoji_code(face, labels)
+    (left, top, right, bottom) = get_emoji_box(face, code=code)
+    emoji = get_emoji_image(code, (left, top, right, bottom), quality)
 
+    # center on the box, a bucketed emoji may be a few pixels bigger
+    left -= (emoji.width - (right - left)) // 2
+    top -= (emoji.height - (bottom - top)) // 2
+    return emoji, (left, top)
 
-def replace_faces(input_stream, faces, output_stream):
-    """Replaces all faces in the given input image with emoji based on the
-    given face annotation data, then writes to the given output.
 
-    The input and output may be either a filename (string), pathlib.Path object,
-    or BufferedIO stream with read and write access, respectively.
+def render_emoji(image, face, labels=(), quality=EMOJI_QUALITY):
+    """Renders an emoji on top of the given image using the given face
+    annotation data.
 
     Args:
-        input_stream: a file-like-object containing an image.
-        faces: a list of face annotation objects from the Google Vision API.
-        output_stream: a file-like-object to write the result to.
+        image: a PIL.Image
+        face: a models.Face record
+        labels: optional label annotations for the face's head
+        quality: emoji resampling quality, see EMOJI_RESAMPLE
     """
-    output_image = Image.open(input_stream)
-    faces_by_depth = sorted(faces, key=get_depth_rank)
+    emoji, position = place_emoji(face, labels, quality)
+    mask = emoji
+    image.paste(emoji, position, mask)
+
 
-    for face in faces_by_depth:
-        render_emoji(output_image, face)
+def replace_faces(image, faces, use_gva_labels=USE_GVA_LABELS, quality=EMOJI_QUALITY):
+    """Replaces all faces in the given image with emoji based on the given
+    face annotation data. Draws on the image in place.
 
-    output_image.save(output_stream)
-    output_image.close()
+    Args:
+        image: a decoded PIL.Image
+        faces: a list of models.Face records, see codec.to_faces
+        use_gva_labels: fallback on Google Vision API label analysis (slow)
+        quality: emoji resampling quality, see EMOJI_RESAMPLE
+    """
+    faces_by_depth = sorted(faces, key=attrgetter('depth'))
+
+    if use_gva_labels:
+        # USE_GVA_LABELS - analyze labels on individual heads, all in one go
+        # (((  AKA USE_BIG_GUNS )))
+        face_labels = get_head_labels(image, faces_by_depth)
+    else:
+        face_labels = [()] * len(faces_by_depth)
 
+    for face, labels in zip(faces_by_depth, face_labels):
+        render_emoji(image, face, labels, quality)
 
-def highlight_faces(input_stream, faces, output_stream):
-    """Draws a bounding box around all faces in the given input image based on
-    the given face annotation data, then writes to the given output.
 
-    The input and output may be either a filename (string), pathlib.Path object,
-    or BufferedIO stream with read and write access, respectively.
+def highlight_faces(image, faces):
+    """Draws a bounding box around all faces in the given image based on the
+    given face annotation data. Draws on the image in place.
 
     Args:
-        input_stream: a file-like-object containing an image.
-        faces: a list of face annotation objects from the Google Vision API.
-        output_stream: a file-like-object to write the result to.
+        image: a decoded PIL.Image
+        faces: a list of models.Face records
     """
-    output_image = Image.open(input_stream)
-    draw = ImageDraw.Draw(output_image)
+    draw = ImageDraw.Draw(image)
     for face in faces:
-        box = [(vertex.x, vertex.y)
-               for vertex in face.bounding_poly.vertices]
-        draw.line(box + [box[0]], width=5, fill='#00ff00')
-    output_image.save(output_stream)
-    output_image.close()
+        draw.line(face.vertices + face.vertices[:1], width=5, fill='#00ff00')
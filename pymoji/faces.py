@@ -1,13 +1,210 @@
 """Replaces detected faces in the given image with emoji."""
+from codecs import getwriter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import os
-from tempfile import NamedTemporaryFile
+import threading
 
-from pymoji import PROJECT_ID
-from pymoji.constants import OUTPUT_DIR, UPLOADS_DIR
-from pymoji.emoji import highlight_faces, replace_faces
+from PIL import Image
+
+from pymoji import CLOUD_UPLOAD_WORKERS, DEDUP_UPLOADS, EMOJI_QUALITY
+from pymoji.animation import get_keyframes, read_frames, save_frames, track_faces
+from pymoji.cache import get_content_key
+from pymoji.codec import to_faces
+from pymoji.constants import DEMO_PATH
+from pymoji.emoji import get_render_version, highlight_faces, replace_faces
+from pymoji.storage import GCSStorage, LocalStorage
 from pymoji.utils import allowed_file, get_id_name, get_json_name, get_output_name, \
-    orient_image, save_to_cloud, write_json
-from pymoji.vision import detect_faces, to_vision_image
+    get_peak_memory, make_buffer, orient_image, write_json
+from pymoji.vision import detect_faces, detect_faces_batch, scale_faces, to_proxy_image, \
+    VisionError
+
+
+# demo run ID-filenames, computed at most once per process and storage backend
+# key: (storage URL root, renderer, quality)
+# value: ID-filename string
+DEMO_RUNS = {}
+DEMO_LOCK = threading.Lock()
+
+
+class FaceRun(object):
+    """A single run of the face pipeline over one source image.
+
+    The upload is kept as bytes and decoded at full resolution only when first
+    drawn on; the oriented PIL.Image then stays in memory for head crops and
+    rendering. Only the final artifacts (JSON and output) get encoded. Uploads
+    that need no rotation are kept byte-for-byte as the input artifact, and the
+    detection proxy is made from those bytes directly, see get_proxy.
+
+    Animated GIFs are decoded frame by frame at detection time. Only a few
+    keyframes are sent to Vision, see animation.get_keyframes, and every frame
+    is rendered with faces tracked between them.
+
+    Use as a context manager to release the decoded image when done.
+    """
+
+    def __init__(self, image_stream, filename, id_filename=None):
+        """
+        Args:
+            image_stream: a BufferedIO containing an image
+            filename: string filename of the source image
+            id_filename: the ID-filename to save under, else a new one
+        """
+        self.filename = filename
+        self.id_filename = id_filename or get_id_name(filename)
+        self.source = image_stream.read()
+        self.data = self.source
+
+        source_image = Image.open(BytesIO(self.source)) # lazy, reads headers only
+        # multi-picture JPEGs (MPO) from phone cameras are stills, use frame 0
+        self.format = 'JPEG' if source_image.format == 'MPO' else source_image.format
+        self.mime_type = Image.MIME.get(self.format, 'application/octet-stream')
+        self.is_animated = (self.format == 'GIF' and
+                            getattr(source_image, 'n_frames', 1) > 1)
+        self._image = orient_image(source_image) # rotate based on EXIF
+        if self._image is not source_image:
+            source_image.close()
+            self.data = None # rotated, so the original bytes are stale
+        self.faces = []
+        self.animation = None # (frames, per-frame faces, durations, loop) once detected
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def image(self):
+        """The oriented PIL.Image, decoded again from the source bytes if
+        unloaded."""
+        if self._image is None:
+            self._image = orient_image(Image.open(BytesIO(self.source)))
+        return self._image
+
+    def unload(self):
+        """Releases the decoded image until it's next needed, e.g. while the
+        run waits on a batched detection request."""
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def close(self):
+        """Releases the decoded image."""
+        self.unload()
+
+    def save_input(self, output_stream):
+        """Writes the oriented source image to the given output, passing the
+        original bytes through untouched when no rotation was needed.
+
+        Args:
+            output_stream: a BufferedIO to write the image to
+        """
+        if self.data is not None:
+            output_stream.write(self.data)
+        else:
+            self.image.save(output_stream, format=self.format)
+
+    def open_input(self):
+        """Returns a binary stream of the oriented source image, positioned at
+        the start. Untouched uploads are wrapped without copying their bytes;
+        rotated ones are encoded into an in-memory spooled buffer.
+        """
+        if self.data is not None:
+            return BytesIO(self.data) # shares the bytes object until written to
+        input_stream = make_buffer()
+        self.save_input(input_stream)
+        input_stream.seek(0)
+        return input_stream
+
+    def get_proxy(self):
+        """Returns a downscaled Google Vision Image for detection plus the scale
+        factors back to full resolution. Untouched uploads are proxied from a
+        fresh lazy open of their bytes, so the full-size image stays undecoded.
+        See vision.to_proxy_image."""
+        if self.data is None:
+            return to_proxy_image(self.image)
+        with Image.open(BytesIO(self.data)) as source_image:
+            return to_proxy_image(source_image, data=self.data)
+
+    def detect(self):
+        """Runs face detection on the in-memory image.
+
+        Returns:
+            a list of models.Face records, scaled to the full image. For
+                animations, every face detected on any keyframe.
+        """
+        if self.is_animated:
+            return self.detect_animated()
+        gv_image, scale = self.get_proxy()
+        self.faces = to_faces(scale_faces(detect_faces(gv_image), scale))
+        return self.faces
+
+    def detect_animated(self):
+        """Decodes every frame of the animated image, runs face detection on
+        keyframes in one batch request, and tracks the faces across the rest.
+
+        Returns:
+            a list of every models.Face record detected on a keyframe
+
+        Raises:
+            VisionError: if the API failed on any keyframe
+        """
+        frames, durations, loop = read_frames(self.image)
+        keyframes = get_keyframes(len(frames))
+        proxies = [to_proxy_image(frames[index]) for index in keyframes]
+        batch_faces = detect_faces_batch([gv_image for (gv_image, _) in proxies])
+        for faces in batch_faces:
+            if isinstance(faces, VisionError):
+                raise faces
+        keyframe_faces = [to_faces(scale_faces(faces, scale))
+                          for faces, (_, scale) in zip(batch_faces, proxies)]
+
+        frame_faces = track_faces(keyframes, keyframe_faces, len(frames))
+        self.animation = (frames, frame_faces, durations, loop)
+        self.faces = [face for faces in keyframe_faces for face in faces]
+        return self.faces
+
+    def write_json(self, json_stream):
+        """Serializes the detected faces to the given TextIO stream."""
+        write_json({'faces': self.faces}, json_stream)
+
+    def render(self, renderer, output_stream, quality=EMOJI_QUALITY):
+        """Draws on the in-memory image with the named renderer and encodes
+        the result to the given output. The source image is modified in place,
+        so call save_input first.
+
+        Args:
+            renderer: the name of the renderer to draw with
+            output_stream: a BufferedIO to write the result to
+            quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
+        """
+        if self.animation:
+            self.render_animated(renderer, output_stream, quality)
+            return
+        if renderer == 'emoji':
+            replace_faces(self.image, self.faces, quality=quality)
+        elif renderer == 'bounding_box':
+            highlight_faces(self.image, self.faces)
+        self.image.save(output_stream, format=self.format)
+
+    def render_animated(self, renderer, output_stream, quality=EMOJI_QUALITY):
+        """Draws on every decoded frame with the named renderer and encodes the
+        result as an animated GIF with the original frame durations and loop
+        count. Skips label analysis, which would cost a request per frame.
+
+        Args:
+            renderer: the name of the renderer to draw with
+            output_stream: a BufferedIO to write the result to
+            quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
+        """
+        (frames, frame_faces, durations, loop) = self.animation
+        for frame, faces in zip(frames, frame_faces):
+            if renderer == 'emoji':
+                replace_faces(frame, faces, use_gva_labels=False, quality=quality)
+            elif renderer == 'bounding_box':
+                highlight_faces(frame, faces)
+        save_frames(frames, durations, loop, output_stream)
 
 
 def process_path(input_path):
@@ -30,105 +227,294 @@ def process_path(input_path):
     return id_filename
 
 
-def process_local(image_stream, filename, renderer):
-    """Local dev server entrypoint that processes the given image and returns
-    the ID-filename from the run. Creates the output directory first if necessary.
+def process_paths(input_paths, storage=None):
+    """Processes the images at the specified input paths with batched face
+    detection and returns the ID-filenames from the run, in order. Paths that
+    aren't image files map to None, and images Vision failed on map to the
+    vision.VisionError, so they can be retried. This is the batch CLI
+    entrypoint.
 
-    Only used when APP.testing == True.
+    Args:
+        input_paths: a list of paths to source image files
+        storage: a storage.Storage for the artifacts, local by default
+
+    Returns:
+        a list of ID-filename strings (or None, or VisionError), one per input path
+    """
+    storage = storage or LocalStorage()
+
+    id_filenames = []
+    indexes = [] # into id_filenames, one per batched run
+    runs = []
+    gv_images = []
+    scales = []
+    with ThreadPoolExecutor(max_workers=CLOUD_UPLOAD_WORKERS) as uploader:
+        uploads = []
+        for input_path in input_paths:
+            filename = os.path.basename(input_path)
+            if not (os.path.isfile(input_path) and allowed_file(filename)):
+                print('skipped non-image file')
+                id_filenames.append(None)
+                continue
+
+            try:
+                with open(input_path, 'rb') as input_file:
+                    run = FaceRun(input_file, filename)
+                uploads.append(save_input(run, storage, uploader))
+                if run.is_animated:
+                    # batches its own keyframes
+                    with run:
+                        try:
+                            if run.detect():
+                                uploads.extend(save_results(run, storage, uploader, 'emoji'))
+                        except VisionError as error:
+                            id_filenames.append(error)
+                        else:
+                            id_filenames.append(run.id_filename)
+                    continue
+                gv_image, scale = run.get_proxy()
+                run.unload() # only the bytes wait on the batch, see FaceRun.image
+            except IOError as error:
+                # don't let one bad image sink the whole batch
+                print('bad image: %s' % error)
+                id_filenames.append(None)
+                continue
+            indexes.append(len(id_filenames))
+            id_filenames.append(run.id_filename)
+            runs.append(run)
+            gv_images.append(gv_image)
+            scales.append(scale)
+
+        # one round-trip per batch instead of per image
+        batch_faces = detect_faces_batch(gv_images)
+
+        for index, run, faces, scale in zip(indexes, runs, batch_faces, scales):
+            with run:
+                if isinstance(faces, VisionError):
+                    print('vision failed on {}: {}'.format(run.filename, faces))
+                    id_filenames[index] = faces
+                    continue
+                run.faces = to_faces(scale_faces(faces, scale))
+                if run.faces:
+                    uploads.extend(save_results(run, storage, uploader, 'emoji'))
+
+        wait_for_uploads(uploads)
+
+    return id_filenames
+
+
+def _upload(storage, data_stream, path, content_type):
+    """Saves then closes the given buffer. Runs on an uploader thread."""
+    with data_stream:
+        return storage.save(data_stream, path, content_type)
+
+
+def save_input(run, storage, uploader, mime_type=None):
+    """Starts saving the oriented source image of the given run. Encodes right
+    away, since rendering later draws over the in-memory image.
 
     Args:
-        image_stream: a BufferedIO containing an image
-        filename: string filename of the source image
+        run: a FaceRun
+        storage: a storage.Storage to save to
+        uploader: a concurrent.futures.Executor to save on
+        mime_type: MIME content type string, else guessed from the image format
 
     Returns:
-        an ID-filename string for the run
+        a Future for the saved URL
     """
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
-        print('created output directory {}'.format(OUTPUT_DIR))
-
-    id_filename = get_id_name(filename)
-    id_path = os.path.join(UPLOADS_DIR, id_filename)
-    print('Saving to file: {}'.format(id_path))
-    with open(id_path, 'wb') as id_file:
-        orient_image(image_stream, id_file) # rotate based on EXIF
-
-    with open(id_path, 'rb') as id_file:
-        gv_image = to_vision_image(input_stream=id_file)
-        faces = detect_faces(gv_image)
-        id_file.seek(0) # reset the file pointer for next use
-
-        if faces:
-            json_filename = get_json_name(id_filename)
-            json_path = os.path.join(OUTPUT_DIR, json_filename)
-            print('Saving to file: {}'.format(json_path))
-            with open(json_path, 'w') as json_file:
-                write_json({'faces': faces}, json_file)
-
-            output_filename = get_output_name(id_filename)
-            output_path = os.path.join(OUTPUT_DIR, output_filename)
-            print('Saving to file: {}'.format(output_path))
-            with open(output_path, 'w+b') as output_file:
-                if renderer == 'emoji':
-                    replace_faces(id_file, faces, output_file)
-                elif renderer == 'bounding_box':
-                    highlight_faces(id_file, faces, output_file)
+    return uploader.submit(_upload, storage, run.open_input(), 'uploads/' + run.id_filename,
+                           mime_type or run.mime_type)
 
-    return id_filename
 
+def save_results(run, storage, uploader, renderer, quality=EMOJI_QUALITY, mime_type=None):
+    """Encodes the JSON metadata and rendered output image of the given run
+    into spooled buffers and starts saving each one as soon as it's ready.
 
-def process_cloud(image_stream, filename, mime_type, renderer):
-    """Production server entrypoint that processes the given image and returns
-    the ID-filename from the run. Uploads both the input and ouput images to
-    Google Cloud Storage.
+    Args:
+        run: a FaceRun with detected faces
+        storage: a storage.Storage to save to
+        uploader: a concurrent.futures.Executor to save on
+        renderer: the name of the renderer to draw with
+        quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
+        mime_type: MIME content type string, else guessed from the image format
 
-    Only used when APP.testing == False.
+    Returns:
+        a list of Futures for the saved URLs
+    """
+    json_stream = make_buffer()
+    run.write_json(getwriter('utf-8')(json_stream))
+    json_stream.seek(0) # reset the stream for next use
+    json_future = uploader.submit(_upload, storage, json_stream,
+                                  'gen/' + get_json_name(run.id_filename), 'application/json')
+
+    output_stream = make_buffer()
+    run.render(renderer, output_stream, quality)
+    output_stream.seek(0) # reset the stream for next use
+    output_future = uploader.submit(_upload, storage, output_stream,
+                                    'gen/' + get_output_name(run.id_filename),
+                                    mime_type or run.mime_type)
+    return [json_future, output_future]
+
+
+def wait_for_uploads(uploads):
+    """Blocks until every given upload Future is done and re-raises the first
+    upload error, if any."""
+    for upload in uploads:
+        upload.result()
 
-    Uses NamedTemporaryFile to create ephemeral binary streams instead of cruft
-    on the webserver file system.
 
-    https://docs.python.org/3/library/tempfile.html#tempfile.NamedTemporaryFile
+def get_dedup_path(data, renderer, quality):
+    """Returns the storage path of the dedup index entry for the given upload
+    bytes and run settings. The entry holds the ID-filename of an earlier run
+    over identical bytes. Changes to the rendering code or emoji rules start a
+    fresh index, see emoji.get_render_version.
+
+    Examples:
+        >>> get_dedup_path(b'face', 'emoji', 'fast')[:6]
+        'index/'
+        >>> get_dedup_path(b'face', 'emoji', 'fast') == get_dedup_path(b'face', 'emoji', 'best')
+        False
+
+    Args:
+        data: the raw upload bytes
+        renderer: the name of the renderer to draw with
+        quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
+
+    Returns:
+        a relative storage path string
+    """
+    return 'index/' + get_content_key(data, renderer, quality, get_render_version())
+
+
+def process_image(image_stream, filename, renderer, storage, mime_type=None,
+                  quality=EMOJI_QUALITY, dedup=DEDUP_UPLOADS, id_filename=None):
+    """Processes the given image, saves the input, JSON metadata and output
+    image to the given storage backend, and returns the ID-filename from the run.
+
+    Uploads are hashed on ingest: if identical bytes were already processed
+    with the same renderer, quality and rendering version (see
+    emoji.get_render_version), the earlier run's ID-filename is
+    returned straight away without calling Vision or re-rendering. The dedup
+    index lives in the storage backend under 'index/', and entries are only
+    written once every artifact of a run has been saved.
+
+    Face detection runs on the in-memory image while the input is being saved,
+    and the JSON and output are saved concurrently on a small thread pool, so a
+    run costs roughly the slowest save plus detection instead of the sum of
+    every network hop. Returns once everything has been saved; save errors are
+    re-raised.
+
+    Artifacts are encoded into SpooledTemporaryFile buffers that stay in memory
+    up to SPOOL_MAX_BYTES, instead of cruft on the (slow) webserver file
+    system. Logs how much the run raised the process's peak memory.
+
+    https://docs.python.org/3/library/tempfile.html#tempfile.SpooledTemporaryFile
+    https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
 
     Args:
         image_stream: a BufferedIO containing an image
         filename: string filename of the source image
-        mime_type: MIME content type string
+        renderer: the name of the renderer to draw with
+        storage: a storage.Storage to save to
+        mime_type: MIME content type string, else guessed from the image format
+        quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
+        dedup: whether to reuse earlier runs over identical uploads
+        id_filename: the ID-filename to save under, else a new one
 
     Returns:
-        an ID-filename string for the run
+        an ID-filename string for the run (an earlier one for duplicates)
     """
-    id_filename = get_id_name(filename)
+    data = image_stream.read()
+    if dedup:
+        dedup_path = get_dedup_path(data, renderer, quality)
+        duplicate = storage.load(dedup_path)
+        if duplicate is not None:
+            id_filename = duplicate.decode('utf-8')
+            print('duplicate upload, reusing run: {}'.format(id_filename))
+            return id_filename
 
-    # suffix for named temp files so pillow can auto match file encodings
-    _, suffix = os.path.splitext(filename)
-    with NamedTemporaryFile(suffix=suffix) as input_stream:
-        orient_image(image_stream, input_stream) # rotate based on EXIF
-        input_stream.seek(0) # reset the stream for next use
+    peak_before = get_peak_memory()
+    with FaceRun(BytesIO(data), filename, id_filename) as run, \
+            ThreadPoolExecutor(max_workers=CLOUD_UPLOAD_WORKERS) as uploader:
+        id_filename = run.id_filename
+        uploads = [save_input(run, storage, uploader, mime_type)]
+        if run.detect():
+            uploads.extend(save_results(run, storage, uploader, renderer, quality, mime_type))
+        wait_for_uploads(uploads)
 
-        save_to_cloud(input_stream, 'uploads/' + id_filename, mime_type)
-        input_stream.seek(0) # reset the stream for next use
+    if dedup:
+        storage.save(BytesIO(id_filename.encode('utf-8')), dedup_path, 'text/plain')
 
-        # gs://bucket_name/object_name
-        input_uri = "gs://{}/uploads/{}".format(PROJECT_ID, id_filename)
-        gv_image = to_vision_image(input_uri=input_uri)
-        faces = detect_faces(gv_image)
+    peak_after = get_peak_memory()
+    print('peak memory: {:.1f} MB (+{:.1f} MB during {})'.format(
+        peak_after / 2**20, (peak_after - peak_before) / 2**20, id_filename))
+    return id_filename
 
-        if faces:
-            with NamedTemporaryFile(suffix=suffix, mode='w+') as json_stream:
-                write_json({'faces': faces}, json_stream)
-                json_stream.seek(0) # reset the stream for next use
 
-                json_filename = get_json_name(id_filename)
-                save_to_cloud(json_stream, 'gen/' + json_filename, 'application/json')
+def get_demo_run(storage, renderer='emoji', quality=EMOJI_QUALITY):
+    """Returns the ID-filename of the demo image processed with the given
+    settings, running it at most once per process. Concurrent first calls
+    wait for the one run instead of starting their own.
 
-            with NamedTemporaryFile(suffix=suffix) as output_stream:
-                if renderer == 'emoji':
-                    replace_faces(input_stream, faces, output_stream)
-                elif renderer == 'bounding_box':
-                    highlight_faces(input_stream, faces, output_stream)
+    The run goes through the dedup index, so once any process (or a deploy
+    step, see manage.py prerender) has rendered the demo, others just look up
+    its ID-filename in storage.
 
-                output_stream.seek(0) # reset the stream for next use
-                output_filename = get_output_name(id_filename)
-                save_to_cloud(output_stream, 'gen/' + output_filename, mime_type)
+    Args:
+        storage: a storage.Storage to save to
+        renderer: the name of the renderer to draw with
+        quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
 
+    Returns:
+        an ID-filename string
+    """
+    key = (storage.get_url(''), renderer, quality)
+    id_filename = DEMO_RUNS.get(key)
+    if id_filename is None:
+        with DEMO_LOCK:
+            id_filename = DEMO_RUNS.get(key) # maybe done while we waited
+            if id_filename is None:
+                with open(DEMO_PATH, 'rb') as image_stream:
+                    id_filename = process_image(image_stream, 'demo.jpg', renderer, storage,
+                                                mime_type='image/jpeg', quality=quality,
+                                                dedup=True)
+                DEMO_RUNS[key] = id_filename
     return id_filename
+
+
+def process_local(image_stream, filename, renderer, quality=EMOJI_QUALITY):
+    """Local dev server entrypoint that processes the given image and returns
+    the ID-filename from the run. Saves to the local static folder.
+
+    Only used when APP.testing == True.
+
+    Args:
+        image_stream: a BufferedIO containing an image
+        filename: string filename of the source image
+        renderer: the name of the renderer to draw with
+        quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
+
+    Returns:
+        an ID-filename string for the run
+    """
+    return process_image(image_stream, filename, renderer, LocalStorage(), quality=quality)
+
+
+def process_cloud(image_stream, filename, mime_type, renderer, quality=EMOJI_QUALITY):
+    """Production server entrypoint that processes the given image and returns
+    the ID-filename from the run. Uploads both the input and ouput images to
+    Google Cloud Storage.
+
+    Only used when APP.testing == False.
+
+    Args:
+        image_stream: a BufferedIO containing an image
+        filename: string filename of the source image
+        mime_type: MIME content type string
+        renderer: the name of the renderer to draw with
+        quality: emoji resampling quality, see emoji.EMOJI_RESAMPLE
+
+    Returns:
+        an ID-filename string for the run
+    """
+    return process_image(image_stream, filename, renderer, GCSStorage(), mime_type, quality)
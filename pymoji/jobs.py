@@ -0,0 +1,223 @@
+"""Background job queue, so slow face runs don't tie up web workers.
+
+Uploads are accepted and enqueued, the request redirects right away, and the
+results page polls the job status until the run is done.
+
+Job status records are plain dicts, e.g.
+    {'job_id': '1504903228457_IMG_2593.JPG', 'status': 'done',
+     'id_filename': '1504903228457_IMG_2593.JPG', 'error': None,
+     'queued_at': 1504903228.46}
+
+https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import json
+import logging
+import os
+import threading
+import time
+
+from pymoji import JOB_HISTORY, JOB_TIMEOUT, JOB_WORKERS
+
+
+# job lifecycle
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+PENDING_STATUSES = set([QUEUED, RUNNING])
+
+# what clients are told about failed jobs, details only go to the logs
+ERROR_MESSAGE = "Sorry, we couldn't process that image."
+TIMEOUT_MESSAGE = 'Sorry, that run got lost. Please try again.'
+
+
+def get_status_path(job_id):
+    """Returns the storage path of the status record for the given job.
+
+    Examples:
+        >>> get_status_path('1504903228457_IMG_2593.JPG')
+        'jobs/1504903228457_IMG_2593.JPG.json'
+    """
+    return 'jobs/{}.json'.format(job_id)
+
+
+def get_job_time(job_id):
+    """Returns when the given job was created, in seconds since the epoch, if
+    its ID is an ID-filename (see utils.get_id_name), else None.
+
+    Examples:
+        >>> get_job_time('1504903228457_IMG_2593.JPG')
+        1504903228.457
+        >>> get_job_time('IMG_2593.JPG') is None
+        True
+    """
+    prefix = job_id.split('_', 1)[0]
+    if prefix.isdigit():
+        return int(prefix) / 1000.0
+    return None
+
+
+class JobQueue(object):
+    """Interface for running jobs in the background and tracking their status."""
+
+    def submit(self, job_id, func, *args, **kwargs):
+        """Enqueues a call to func(*args, **kwargs) and returns immediately.
+        The job's result, if any, is reported as its 'id_filename'.
+
+        Args:
+            job_id: a unique string to track the job by
+            func: the function to run
+        """
+        raise NotImplementedError
+
+    def get_status(self, job_id):
+        """Returns the status record of the given job, or None if unknown."""
+        raise NotImplementedError
+
+
+class LocalJobQueue(JobQueue):
+    """Runs jobs on a thread pool in this process. Most of a face run is spent
+    waiting on the Vision and Cloud Storage APIs, so threads overlap well.
+
+    Status records are kept in memory for the most recent jobs and, given a
+    storage backend, also saved there when a job is queued and when it ends,
+    so any web worker can answer status polls. The queued record is saved
+    before submit returns; the final one in order on a background thread, off
+    the request path. Thread-safe and fork-safe.
+
+    Jobs older than the timeout are never looked up in storage: by then they
+    are long done (or lost). Shared records still pending past the timeout
+    belonged to a worker that went away, and are reported as errors.
+    """
+
+    def __init__(self, storage=None, max_workers=JOB_WORKERS, max_history=JOB_HISTORY,
+                 timeout=JOB_TIMEOUT):
+        """
+        Args:
+            storage: an optional storage.Storage to share status records through
+            max_workers: number of jobs to run at once
+            max_history: number of status records to keep in memory
+            timeout: seconds after which a job is assumed done or lost
+        """
+        self.storage = storage
+        self.max_workers = max_workers
+        self.max_history = max_history
+        self.timeout = timeout
+        self._pid = None
+        self._executor = None
+        self._writer = None
+        self._jobs = OrderedDict() # key: job ID, value: (status record, Future)
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """Returns this process's thread pool, creating it if necessary. Threads
+        don't survive a fork, so forked workers (e.g. gunicorn) get their own."""
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                self._pid = pid
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                # a single writer keeps each job's saved records in order
+                self._writer = ThreadPoolExecutor(max_workers=1)
+                self._jobs = OrderedDict()
+            return self._executor
+
+    def _remember(self, job_id, record):
+        """Keeps the given status record in memory, dropping the oldest
+        records beyond max_history."""
+        with self._lock:
+            _, future = self._jobs.get(job_id, (None, None))
+            self._jobs[job_id] = (record, future)
+            self._jobs.move_to_end(job_id)
+            while len(self._jobs) > self.max_history:
+                self._jobs.popitem(last=False)
+
+    def _set_status(self, job_id, status, id_filename=None, error=None):
+        """Updates the status record of the given job and shares it via storage."""
+        with self._lock:
+            previous, _ = self._jobs.get(job_id, (None, None))
+        record = {
+            'job_id': job_id,
+            'status': status,
+            'id_filename': id_filename,
+            'error': error,
+            'queued_at': previous['queued_at'] if previous else time.time(),
+        }
+        self._remember(job_id, record)
+
+        if not self.storage or status == RUNNING:
+            return
+        if status == QUEUED:
+            # before the redirect, so whichever worker gets the poll finds it
+            self._save(record)
+        else:
+            self._writer.submit(self._save, record)
+
+    def _save(self, record):
+        """Saves the given status record to storage, on the writer thread."""
+        try:
+            data = BytesIO(json.dumps(record).encode('utf-8'))
+            self.storage.save(data, get_status_path(record['job_id']), 'application/json')
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Failed to save the status of job %s', record['job_id'])
+
+    def _is_expired(self, created):
+        """Returns True iff the given creation time is older than the timeout."""
+        return created is not None and time.time() - created > self.timeout
+
+    def _run(self, job_id, func, args, kwargs):
+        """Runs a job on a pool thread and records how it went."""
+        self._set_status(job_id, RUNNING)
+        try:
+            id_filename = func(*args, **kwargs)
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Job %s failed', job_id)
+            self._set_status(job_id, ERROR, error=ERROR_MESSAGE)
+        else:
+            self._set_status(job_id, DONE, id_filename=id_filename)
+
+    def submit(self, job_id, func, *args, **kwargs):
+        executor = self._get_executor()
+        self._set_status(job_id, QUEUED)
+        future = executor.submit(self._run, job_id, func, args, kwargs)
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id] = (self._jobs[job_id][0], future)
+
+    def get_status(self, job_id):
+        with self._lock:
+            record, _ = self._jobs.get(job_id, (None, None))
+        if record is not None or not self.storage or self._is_expired(get_job_time(job_id)):
+            return record
+
+        data = self.storage.load(get_status_path(job_id))
+        if data is None:
+            return None
+        record = json.loads(data.decode('utf-8'))
+        if record['status'] not in PENDING_STATUSES:
+            self._remember(job_id, record) # final, no need to load it again
+        elif self._is_expired(record.get('queued_at')):
+            record = dict(record, status=ERROR, error=TIMEOUT_MESSAGE)
+        return record
+
+    def wait(self, job_id, timeout=None):
+        """Blocks until the given job, if it's running in this process, is
+        done and its status is saved. Handy for tests and scripts.
+
+        Args:
+            job_id: the job to wait for
+            timeout: maximum seconds to wait, or None to wait forever
+
+        Returns:
+            the job's status record, or None if unknown
+        """
+        with self._lock:
+            _, future = self._jobs.get(job_id, (None, None))
+        if future is not None:
+            future.result(timeout)
+            # the writer runs saves in order, so this one goes after the job's
+            self._writer.submit(lambda: None).result(timeout)
+        return self.get_status(job_id)
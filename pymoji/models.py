@@ -1,4 +1,4 @@
-"""Schema metadata for JSON serialization.
+"""Schema metadata for JSON serialization, and the in-memory Face record.
 
 Lightweight wrappers of Google Vision API models found here:
   https://cloud.google.com/vision/docs/reference/rest/v1/images/annotate
@@ -40,3 +40,77 @@ class FaceSchema(Schema):
 
 class AnnotationsSchema(Schema):
     faces = fields.Nested(FaceSchema, many=True)
+
+
+class Face(object):
+    """Lightweight, read-only face annotation record. Built once per face from
+    a Google Vision API response or loaded JSON (see codec.to_faces), with the
+    bounding box and depth precomputed, so rendering, ranking and
+    serialization never walk protobufs again.
+
+    Likelihood attributes use the same names and values as the Google Vision
+    API, e.g. face.joy_likelihood == constants.VERY_LIKELY.
+    """
+    __slots__ = (
+        'vertices',
+        'box',
+        'depth',
+        'detection_confidence',
+        'sorrow_likelihood',
+        'anger_likelihood',
+        'surprise_likelihood',
+        'headwear_likelihood',
+        'joy_likelihood',
+    )
+
+    def __init__(self, vertices, detection_confidence=0.0, sorrow_likelihood=0,
+                 anger_likelihood=0, surprise_likelihood=0, headwear_likelihood=0,
+                 joy_likelihood=0):
+        """
+        Args:
+            vertices: the 4 (x, y) bounding_poly corners, clockwise from the
+                top-left corner
+            detection_confidence: a float from 0 to 1
+            *_likelihood: Google Vision API Likelihood enum values
+        """
+        self.vertices = tuple(vertices)
+        (left, top) = self.vertices[0]
+        (right, bottom) = self.vertices[2]
+        self.box = (left, top, right, bottom)
+        # crude depth: people rarely hang upside down, so higher up ~ further away
+        self.depth = top
+        self.detection_confidence = detection_confidence
+        self.sorrow_likelihood = sorrow_likelihood
+        self.anger_likelihood = anger_likelihood
+        self.surprise_likelihood = surprise_likelihood
+        self.headwear_likelihood = headwear_likelihood
+        self.joy_likelihood = joy_likelihood
+
+    def __repr__(self):
+        return 'Face(box={}, joy={})'.format(self.box, self.joy_likelihood)
+
+    def __eq__(self, other):
+        return isinstance(other, Face) and self.to_row() == other.to_row()
+
+    def __hash__(self):
+        return hash(self.to_row())
+
+    @classmethod
+    def from_row(cls, row):
+        """Builds a record from a codec row: 8 coordinates, then the fields."""
+        return cls(zip(row[0:8:2], row[1:8:2]), *row[8:])
+
+    def to_row(self):
+        """Flattens the record back into a codec row."""
+        return tuple(coordinate for vertex in self.vertices for coordinate in vertex) + (
+            self.detection_confidence,
+            self.sorrow_likelihood,
+            self.anger_likelihood,
+            self.surprise_likelihood,
+            self.headwear_likelihood,
+            self.joy_likelihood,
+        )
+
+    def moved(self, vertices):
+        """Returns a copy of this record with the given bounding_poly corners."""
+        return Face(vertices, *self.to_row()[8:])
@@ -0,0 +1,110 @@
+"""Background Slack notifications, so chat never slows down an upload.
+
+Uploads are queued in memory and a daemon thread posts them as one digest
+message per interval over a keep-alive session. When the queue is full, new
+notifications are dropped and counted rather than blocking the request.
+
+https://docs.python.org/3/library/queue.html
+https://api.slack.com/incoming-webhooks
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+from pymoji import SLACK_DIGEST_SECONDS, SLACK_QUEUE_SIZE
+from pymoji.utils import format_upload_message, post_to_slack
+
+
+class SlackNotifier(object):
+    """Batching, bounded, fire-and-forget Slack upload notifier. Thread-safe
+    and fork-safe: each process gets its own queue and sender thread."""
+
+    def __init__(self, interval=SLACK_DIGEST_SECONDS, max_queue=SLACK_QUEUE_SIZE,
+                 send=post_to_slack, timeout=5):
+        """
+        Args:
+            interval: seconds to collect uploads for before sending a digest
+            max_queue: maximum number of unsent uploads to hold
+            send: a function(message, timeout) that posts to Slack and
+                returns the HTTP status code, see utils.post_to_slack
+            timeout: seconds to wait for Slack, off the request path
+        """
+        self.interval = interval
+        self.max_queue = max_queue
+        self.send = send
+        self.timeout = timeout
+        self.stats = {'queued': 0, 'dropped': 0, 'messages': 0, 'failures': 0}
+        self._pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def _get_queue(self):
+        """Returns this process's queue, starting its sender thread if
+        necessary. Threads don't survive a fork, so forked workers get their own."""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = queue.Queue(maxsize=self.max_queue)
+                    sender = threading.Thread(target=self._run, args=(self._queue,),
+                                              name='slack-notifier', daemon=True)
+                    sender.start()
+                    self._pid = pid
+        return self._queue
+
+    def notify(self, id_filename):
+        """Queues a notification about the given upload. Never blocks.
+
+        Args:
+            id_filename: the link-about filename of the upload
+
+        Returns:
+            True if queued, False if dropped because the queue is full
+        """
+        try:
+            self._get_queue().put_nowait((id_filename, int(round(time.time()))))
+        except queue.Full:
+            self.stats['dropped'] += 1
+            return False
+        self.stats['queued'] += 1
+        return True
+
+    def flush(self):
+        """Blocks until everything queued so far has been sent (or failed)."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def _run(self, uploads):
+        """Sender thread: waits for an upload, collects whatever else comes in
+        during the interval, and posts it all as one digest."""
+        while True:
+            batch = [uploads.get()]
+            deadline = time.time() + self.interval
+            while len(batch) < self.max_queue:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(uploads.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                id_filenames = [id_filename for (id_filename, _) in batch]
+                msg = format_upload_message(id_filenames, unix_time=batch[-1][1])
+                print(msg)
+                status = self.send(msg, timeout=self.timeout)
+                if status >= 400:
+                    raise RequestException('Slack replied {}'.format(status))
+                self.stats['messages'] += 1
+            except Exception: # pylint: disable=broad-except
+                # keep the sender alive no matter what, or every later upload is dropped
+                self.stats['failures'] += 1
+                logging.exception('Failed to send %d upload(s) to Slack.', len(batch))
+            finally:
+                for _ in batch:
+                    uploads.task_done()
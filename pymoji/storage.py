@@ -0,0 +1,214 @@
+"""Storage backends for run artifacts: uploaded inputs, JSON metadata and
+rendered outputs.
+
+Every backend addresses artifacts by the same relative paths, e.g.
+'uploads/<id-filename>' or 'gen/<json-filename>', so the face pipeline can run
+unchanged against Google Cloud Storage, the local static folder, or memory.
+
+https://googlecloudplatform.github.io/google-cloud-python/latest/storage/client.html
+https://googlecloudplatform.github.io/google-cloud-python/latest/storage/buckets.html
+"""
+import os
+import threading
+
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
+
+from pymoji import PROJECT_ID
+from pymoji.constants import (CLOUD_ROOT, IMMUTABLE_CACHE_CONTROL, IMMUTABLE_PREFIXES,
+    STATIC_DIR)
+
+
+# Process-wide Cloud Storage client and its bucket handles. The client keeps a
+# pooled HTTP session, so reusing it saves a connection setup per upload, and
+# cached buckets save a metadata round-trip. Like the Vision client pool, it
+# starts over whenever the process ID changes (e.g. in forked workers).
+_GCS = {
+    'pid': None,
+    'lock': threading.Lock(),
+    'client': None,
+    'buckets': {},
+}
+
+
+def get_gcs_bucket(bucket_name, project=PROJECT_ID):
+    """Returns a cached Cloud Storage Bucket handle on the process-wide client.
+    Thread-safe and fork-safe.
+
+    Uses client.bucket() rather than client.get_bucket(), which would make an
+    extra request for the bucket metadata every time.
+
+    Args:
+        bucket_name: the name of the bucket
+        project: the Google Cloud project ID
+
+    Returns:
+        a google.cloud.storage.Bucket
+    """
+    pid = os.getpid()
+    with _GCS['lock']:
+        if _GCS['pid'] != pid:
+            # fresh process (or a forked child): drop any inherited connections
+            _GCS.update(pid=pid, client=None, buckets={})
+        if _GCS['client'] is None:
+            _GCS['client'] = storage.Client(project=project)
+        bucket = _GCS['buckets'].get(bucket_name)
+        if bucket is None:
+            bucket = _GCS['client'].bucket(bucket_name)
+            _GCS['buckets'][bucket_name] = bucket
+    return bucket
+
+
+def get_stream_size(data_stream):
+    """Returns the number of bytes left in the given seekable binary stream,
+    leaving its position unchanged.
+
+    Examples:
+        >>> from io import BytesIO
+        >>> stream = BytesIO(b'emoji')
+        >>> stream.seek(2)
+        2
+        >>> get_stream_size(stream), stream.tell()
+        (3, 2)
+    """
+    start = data_stream.tell()
+    data_stream.seek(0, os.SEEK_END)
+    end = data_stream.tell()
+    data_stream.seek(start)
+    return end - start
+
+
+class Storage(object):
+    """Interface for a place to keep run artifacts."""
+
+    def save(self, data_stream, path, content_type):
+        """Saves the data in the given binary stream, from its current position,
+        at the given path and returns its URL.
+
+        Args:
+            data_stream: a binary IO stream object with read access
+            path: the relative destination path, e.g. 'gen/foo.json'
+            content_type: MIME content type
+
+        Returns:
+            a URL string
+        """
+        raise NotImplementedError
+
+    def load(self, path):
+        """Returns the bytes saved at the given path, or None if missing."""
+        raise NotImplementedError
+
+    def exists(self, path):
+        """Returns True iff something is saved at the given path."""
+        return self.load(path) is not None
+
+    def get_url(self, path):
+        """Returns the URL the given path is served from."""
+        raise NotImplementedError
+
+
+class GCSStorage(Storage):
+    """Google Cloud Storage bucket, e.g. for the production server."""
+
+    def __init__(self, bucket_name=PROJECT_ID, project=PROJECT_ID):
+        """
+        Args:
+            bucket_name: the name of the bucket to save to
+            project: the Google Cloud project ID
+        """
+        self.bucket_name = bucket_name
+        self.project = project
+
+    def save(self, data_stream, path, content_type):
+        print('Uploading to Google Cloud: {} ...'.format(path))
+        blob = get_gcs_bucket(self.bucket_name, self.project).blob(path)
+        # artifacts never change, everything else must be revalidated
+        if path.startswith(IMMUTABLE_PREFIXES):
+            blob.cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            blob.cache_control = 'no-cache'
+        # a known size makes this a single multipart request instead of a
+        # resumable upload session, which costs an extra round-trip
+        blob.upload_from_file(data_stream, content_type=content_type,
+                              size=get_stream_size(data_stream))
+        print('...upload completed.')
+        return self.get_url(path)
+
+    def load(self, path):
+        blob = get_gcs_bucket(self.bucket_name, self.project).blob(path)
+        try:
+            return blob.download_as_string()
+        except NotFound:
+            return None
+
+    def exists(self, path):
+        return get_gcs_bucket(self.bucket_name, self.project).blob(path).exists()
+
+    def get_url(self, path):
+        # The public URL can be used to directly access the uploaded file via HTTP.
+        return CLOUD_ROOT + self.bucket_name + '/' + path
+
+
+class LocalStorage(Storage):
+    """Directory on the local file system, e.g. the static folder served by
+    the local dev server."""
+
+    def __init__(self, root=STATIC_DIR, url_root='/static/'):
+        """
+        Args:
+            root: the directory to save under
+            url_root: the URL prefix root is served from
+        """
+        self.root = root
+        self.url_root = url_root
+
+    def _get_path(self, path):
+        return os.path.join(self.root, path)
+
+    def save(self, data_stream, path, content_type):
+        file_path = self._get_path(path)
+        directory = os.path.dirname(file_path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+            print('created output directory {}'.format(directory))
+        print('Saving to file: {}'.format(file_path))
+        with open(file_path, 'wb') as output_file:
+            for chunk in iter(lambda: data_stream.read(64 * 1024), b''):
+                output_file.write(chunk)
+        return self.get_url(path)
+
+    def load(self, path):
+        try:
+            with open(self._get_path(path), 'rb') as input_file:
+                return input_file.read()
+        except (IOError, OSError):
+            return None
+
+    def exists(self, path):
+        return os.path.isfile(self._get_path(path))
+
+    def get_url(self, path):
+        return self.url_root + path
+
+
+class MemoryStorage(Storage):
+    """Dict-backed fake for tests and offline load testing."""
+
+    def __init__(self):
+        self.blobs = {} # key: path, value: (bytes, content type)
+        self._lock = threading.Lock()
+
+    def save(self, data_stream, path, content_type):
+        data = data_stream.read()
+        with self._lock:
+            self.blobs[path] = (data, content_type)
+        return self.get_url(path)
+
+    def load(self, path):
+        with self._lock:
+            data, _ = self.blobs.get(path, (None, None))
+        return data
+
+    def get_url(self, path):
+        return 'memory://' + path
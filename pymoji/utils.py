@@ -3,24 +3,57 @@
 https://docs.python.org/3/tutorial/inputoutput.html
 https://docs.python.org/3/library/io.html
 """
-from io import BytesIO
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from io import BytesIO, UnsupportedOperation
+import json
 import os
+import resource
+import sys
+from tempfile import SpooledTemporaryFile
+import threading
 import time
 import logging
 
-import exifread
-from google.cloud import storage, error_reporting
+from google.cloud import error_reporting
 from PIL import Image
 import requests
 from requests.exceptions import Timeout
 from werkzeug.utils import secure_filename
 
-from pymoji import PROJECT_ID
-from pymoji.models import AnnotationsSchema
+from pymoji import METADATA_CACHE_SIZE, METADATA_CACHE_TTL, PROJECT_ID, SPOOL_MAX_BYTES
+from pymoji.cache import LRUCache
+from pymoji.codec import decode_faces, decode_json, encode_json, validate_annotations
+from pymoji.storage import GCSStorage
 from pymoji.constants import (ALLOWED_EXTENSIONS, PYMOJI_WEBHOOK_USERNAME,
     PYMOJI_WEBHOOK_ICON, PYMOJI_WEBHOOK_URL)
 
 
+# EXIF orientation tag ID and the transposes that undo each rotation
+# key: EXIF orientation value
+# value: (PIL transpose method, counter-clockwise degrees)
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ROTATIONS = {
+    3: (Image.ROTATE_180, 180),
+    6: (Image.ROTATE_270, 270),
+    8: (Image.ROTATE_90, 90),
+}
+
+
+# Process-wide keep-alive HTTP session for downloads. Like the API client
+# pools, it starts over whenever the process ID changes (e.g. forked workers).
+_HTTP_SESSION = {
+    'pid': None,
+    'lock': threading.Lock(),
+    'session': None,
+}
+
+# parsed JSON metadata by URI, for hot results pages. Results never change
+# once written, the TTL just bounds staleness if one is ever rewritten.
+# key: JSON metadata URI
+# value: a metadata object matching models.AnnotationsSchema (don't mutate!)
+METADATA_CACHE = LRUCache(METADATA_CACHE_SIZE, sizeof=lambda _: 1, ttl=METADATA_CACHE_TTL)
+
+
 def shell(cmd, fail_on_error=True):
     """Convenience wrapper function."""
     print(cmd)
@@ -56,80 +89,136 @@ def allowed_file(filename):
 
 
 def save_to_cloud(data_stream, filename, content_type):
-    """Saves the data in the given IO stream to the Google Storage Cloud and
-    returns the new public URL.
+    """Streams the data in the given IO stream, from its current position, to
+    the Google Storage Cloud and returns the new public URL. Reuses the pooled
+    client and cached bucket, see storage.GCSStorage.
 
     https://cloud.google.com/appengine/docs/flexible/python/using-cloud-storage
 
     Args:
-        data_stream: an IO stream object with read access
+        data_stream: a binary IO stream object with read access
         filename: the desired destination filename
         content_type: MIME content type
 
     Returns:
         a publicly accessible URL string
     """
-    print('Uploading to Google Cloud: {} ...'.format(filename))
+    return GCSStorage().save(data_stream, filename, content_type)
 
-    # Create a Cloud Storage client.
-    gcs = storage.Client(project=PROJECT_ID)
 
-    # Get the bucket that the file will be uploaded to.
-    bucket = gcs.get_bucket(PROJECT_ID)
+class SpooledBuffer(SpooledTemporaryFile):
+    """A SpooledTemporaryFile without a file descriptor. Pillow's encoders
+    (e.g. JPEG and GIF) call fileno() to write straight to the file, which
+    would roll the buffer over to disk right away; without one they write
+    through it like any other stream."""
 
-    # Create a new blob and upload the file's content.
-    blob = bucket.blob(filename)
+    def fileno(self):
+        raise UnsupportedOperation('fileno')
 
-    blob.upload_from_string(
-        data_stream.read(),
-        content_type=content_type
-    )
 
-    print('...upload completed.')
-    # The public URL can be used to directly access the uploaded file via HTTP.
-    return blob.public_url
+def make_buffer(max_size=SPOOL_MAX_BYTES):
+    """Returns an ephemeral binary stream that stays in memory until it grows
+    past max_size bytes, then rolls over to a temp file on disk.
 
+    https://docs.python.org/3/library/tempfile.html#tempfile.SpooledTemporaryFile
 
-def report_upload_to_slack(id_filename):
-    """Webhook to let Slack know someone has uploaded to our google cloud.
-    If this hook fails it times out after 0.5 seconds.
+    Args:
+        max_size: in-memory size limit in bytes
+
+    Returns:
+        a SpooledBuffer opened for binary read/write
+    """
+    return SpooledBuffer(max_size=max_size, mode='w+b')
 
-    Example message payload:
+
+def get_peak_memory():
+    """Returns the peak resident set size of this process so far, in bytes.
+    It only ever grows, so the difference across a request is how much that
+    request raised the high-water mark.
+
+    https://docs.python.org/3/library/resource.html#resource.getrusage
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak # already in bytes on macOS
+    return peak * 1024 # kilobytes on Linux
+
+
+def format_upload_message(id_filenames, unix_time=None):
+    """Formats a Slack message about the given uploads.
+
+    Example message:
         At <!date^1504903239^{date_short} {time}|Friday, 08 Sep 2017  1:40 PM>, someone uploaded:
         <http://tensorbros.com/emojivision/1504903228457_IMG_2593.JPG|1504903228457_IMG_2593.JPG>
 
     Args:
-        id_filename: the link-about filename we've created to store and reference this upload
+        id_filenames: a list of the link-about filenames of the uploads
+        unix_time: when to say it happened, defaults to now
 
     Returns:
-        an integer status code
+        a Slack message string
     """
-    url = PYMOJI_WEBHOOK_URL
-    msg_raw = "At {time}, someone uploaded:\n<http://tensorbros.com/emojivision/{file}|{file}>"
+    if len(id_filenames) == 1:
+        msg_raw = "At {time}, someone uploaded:\n{links}"
+    else:
+        msg_raw = "By {time}, " + str(len(id_filenames)) + " uploads:\n{links}"
+    link_raw = "<http://tensorbros.com/emojivision/{file}|{file}>"
 
     # format unix time into slack client template
     # https://api.slack.com/docs/message-formatting#formatting_dates
     time_raw = "<!date^{unix_time}^{slack_template}|{fallback}>"
-    unix_time = int(round(time.time()))
+    if unix_time is None:
+        unix_time = int(round(time.time()))
     # these curly braces are formatted by slack client, not python!
     slack_template = "{date_short} {time}"
     fallback = timestamp_for_logs() # use prior approach as fallback
     time_msg = time_raw.format(unix_time=unix_time, slack_template=slack_template,
         fallback=fallback)
 
-    msg = msg_raw.format(time=time_msg, file=id_filename)
-    print(msg)
+    links = '\n'.join(link_raw.format(file=id_filename) for id_filename in id_filenames)
+    return msg_raw.format(time=time_msg, links=links)
+
 
+def post_to_slack(msg, timeout=0.5):
+    """Posts the given message to our Slack webhook over the pooled session.
+
+    Args:
+        msg: a Slack message string
+        timeout: seconds to wait for Slack
+
+    Returns:
+        an integer status code
+
+    Raises:
+        requests.exceptions.RequestException if the post fails
+    """
     payload = {
       "text": msg,
       "username": PYMOJI_WEBHOOK_USERNAME,
       "icon_emoji": PYMOJI_WEBHOOK_ICON
       }
     headers = {'content-type': 'application/json'}
+    response = get_http_session().post(PYMOJI_WEBHOOK_URL, json=payload, headers=headers,
+                                       timeout=timeout)
+    return response.status_code
+
+
+def report_upload_to_slack(id_filename):
+    """Webhook to let Slack know someone has uploaded to our google cloud.
+    If this hook fails it times out after 0.5 seconds. Blocks, so prefer the
+    batching slack.SlackNotifier on the request path.
+
+    Args:
+        id_filename: the link-about filename we've created to store and reference this upload
+
+    Returns:
+        an integer status code
+    """
+    msg = format_upload_message([id_filename])
+    print(msg)
 
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=0.5)
-        status = response.status_code
+        status = post_to_slack(msg)
     except Timeout:
         # log the error to google's stackdriver TODO: abstract this
         error_client = error_reporting.Client(project=PROJECT_ID)
@@ -143,51 +232,91 @@ def report_upload_to_slack(id_filename):
 
 
 def write_json(annotation_data, json_stream):
-    """Serializes the given metadata object with marshmallow and writes the
-    resulting JSON string to the given TextIO stream.
+    """Serializes the given metadata object and writes the resulting JSON
+    string, matching models.AnnotationsSchema, to the given TextIO stream.
+    See codec.encode_json.
 
     Args:
         annotation_data: a metadata object matching models.AnnotationsSchema
         json_stream: a TextIO stream with write access to write JSON to
     """
-    schema = AnnotationsSchema()
-    result = schema.dumps(annotation_data)
-    json_stream.write(result.data)
+    json_stream.write(encode_json(annotation_data))
 
 
-def load_json(json_stream):
-    """Deserializes the JSON metadata from the given TextIO stream using
-    marshmallow and returns the resulting object.
+def load_json(json_stream, validate=False):
+    """Deserializes the JSON metadata from the given TextIO stream and returns
+    the resulting object. See codec.decode_json.
 
     Args:
         json_stream: a TextIO stream with read access containing the JSON metadata
+        validate: check it against models.AnnotationsSchema with marshmallow
 
     Returns:
         a metadata object matching models.AnnotationsSchema
     """
-    schema = AnnotationsSchema()
-    result = schema.loads(json_stream.read())
-    return result.data
+    return decode_json(json_stream.read(), validate)
+
+
+def load_faces(json_stream, validate=False):
+    """Deserializes the JSON metadata from the given TextIO stream straight
+    into models.Face records, ready to render. See codec.decode_faces.
+
+    Args:
+        json_stream: a TextIO stream with read access containing the JSON metadata
+        validate: check it against models.AnnotationsSchema with marshmallow
+
+    Returns:
+        a list of models.Face records
+    """
+    return decode_faces(json_stream.read(), validate)
 
 
-def download_json(json_uri):
-    """Downloads the JSON metadata at the given URI, deserializes it with
-    marshmallow, and returns the resulting object.
+def get_http_session():
+    """Returns this process's pooled keep-alive requests.Session, creating it
+    if necessary. Thread-safe and fork-safe.
+
+    http://docs.python-requests.org/en/master/user/advanced/#session-objects
+    """
+    pid = os.getpid()
+    with _HTTP_SESSION['lock']:
+        if _HTTP_SESSION['pid'] != pid:
+            # fresh process (or a forked child): drop any inherited connections
+            _HTTP_SESSION.update(pid=pid, session=None)
+        if _HTTP_SESSION['session'] is None:
+            _HTTP_SESSION['session'] = requests.Session()
+        return _HTTP_SESSION['session']
+
+
+def download_json(json_uri, cache=METADATA_CACHE):
+    """Downloads the JSON metadata at the given URI, deserializes and
+    validates it, and returns the resulting object. Parsed metadata is cached
+    in memory when valid, so repeat views of a result skip the download and
+    the parse.
 
     http://docs.python-requests.org/en/master/user/quickstart/
 
     Args:
         image_uri: an metadata uri, e.g. 'http://cdn/path/to/image-meta.json'
+        cache: an LRUCache of parsed metadata by URI, or None to always download
 
     Returns:
         a metadata object based on annotations from the Google Vision API.
+            Cached objects are shared, so treat them as read-only.
     """
+    if cache is not None:
+        data = cache.get(json_uri)
+        if data is not None:
+            return data
+
     print('Downloading metadata: {} ...'.format(json_uri))
-    response = requests.get(json_uri)
+    response = get_http_session().get(json_uri)
     print('...download completed.')
-    schema = AnnotationsSchema()
-    result = schema.loads(response.text)
-    return result.data
+    (data, errors) = validate_annotations(decode_json(response.text))
+
+    # don't pin partial metadata, a later download may be whole again
+    if cache is not None and response.ok and not errors:
+        cache.put(json_uri, data)
+    return data
 
 
 def download_image(image_uri):
@@ -203,43 +332,54 @@ def download_image(image_uri):
         a PIL.Image
     """
     print('Downloading source image: {} ...'.format(image_uri))
-    response = requests.get(image_uri)
+    response = get_http_session().get(image_uri)
     print('...download completed.')
     return Image.open(BytesIO(response.content))
 
 
-def orient_image(input_stream, output_stream):
-    """Rotates the image in the given BufferedIO based on its EXIF orientation
-    metadata, then exports the result to the given destination BufferedIO.
+def get_exif_orientation(image):
+    """Reads the EXIF orientation tag from the given (lazily opened) PIL.Image
+    without decoding any pixels. Missing or unreadable EXIF counts as 1.
+
+    http://www.impulseadventure.com/photo/exif-orientation.html
+
+    Args:
+        image: a PIL.Image straight from Image.open
+
+    Returns:
+        an integer EXIF orientation, 1 meaning upright
+    """
+    get_exif = getattr(image, '_getexif', None) # only JPEG and friends carry EXIF
+    if not get_exif:
+        return 1
+    try:
+        exif = get_exif() or {}
+    except Exception: # pylint: disable=broad-except
+        return 1 # corrupt metadata shouldn't sink an upload
+    return exif.get(EXIF_ORIENTATION_TAG, 1)
+
+
+def orient_image(image):
+    """Rotates the given PIL.Image based on its EXIF orientation metadata.
+    Lossless fast path: when no rotation is needed the very same (still
+    undecoded) image object is returned, so callers can reuse the original
+    bytes as-is.
 
     https://stackoverflow.com/questions/4228530/pil-thumbnail-is-rotating-my-image
 
     Args:
-        input_stream: a BufferedIO image file-object with EXIF metadata
-        output_stream: a file-object to save the result to
+        image: a PIL.Image straight from Image.open
+
+    Returns:
+        the oriented PIL.Image, or the given image if already upright
     """
-    tags = []
-    tags = exifread.process_file(input_stream)
-    input_stream.seek(0) # Reset the file pointer, so we can read the file again
-
-    image = Image.open(input_stream)
-    orientation_key = 'Image Orientation'
-    if tags and orientation_key in tags:
-        orientation_tag = tags[orientation_key]
-        if orientation_tag.values:
-            tag_value = orientation_tag.values[0] # assume this for now???
-            if tag_value == 3:
-                image = image.rotate(180, expand=True)
-                print('rotated image 180 degrees')
-            elif tag_value == 6:
-                image = image.rotate(270, expand=True)
-                print('rotated image 270 degrees')
-            elif tag_value == 8:
-                image = image.rotate(90, expand=True)
-                print('rotated image 90 degrees')
-
-    image.save(output_stream)
-    image.close()
+    orientation = get_exif_orientation(image)
+    if orientation not in EXIF_ROTATIONS:
+        return image
+
+    (method, degrees) = EXIF_ROTATIONS[orientation]
+    print('rotated image {} degrees'.format(degrees))
+    return image.transpose(method)
 
 
 def get_id_name(filename, testing_timestamp=None):
@@ -310,19 +450,159 @@ def get_output_name(input_filename):
     return "{}-output{}".format(root, extension)
 
 
-def process_folder(path, file_processor):
-    """Runs the given file processing operation on each image in
-    the given directory.
+def iter_image_paths(path):
+    """Recursively yields the path of every allowed image file under the given
+    directory, in sorted order.
+
+    Args:
+        path: a directory path string
+
+    Yields:
+        file path strings
+    """
+    for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_image_paths(entry.path)
+        elif entry.is_file() and allowed_file(entry.name):
+            yield entry.path
+
+
+def read_manifest(manifest_path):
+    """Reads a JSONL run manifest written by process_folder and returns the
+    paths that were already processed successfully.
+
+    Args:
+        manifest_path: path to a JSONL manifest file
+
+    Returns:
+        a set of absolute file path strings
+    """
+    done = set()
+    if not os.path.isfile(manifest_path):
+        return done
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # e.g. a line truncated by a crash
+            if record.get('status') == 'ok':
+                done.add(os.path.abspath(record['path']))
+    return done
+
+
+def run_file_processor(file_processor, file_paths, batch):
+    """Runs the given file processor on the given paths and returns one
+    manifest record per path. Never raises, so one bad file can't take down a
+    whole run. Runs inside worker processes, see process_folder.
+
+    Args:
+        file_processor: a function(input_path), or a function(input_paths)
+            when batch is True
+        file_paths: a list of file path strings
+        batch: whether or not file_processor takes the whole list at once.
+            Batch processors may return an exception in place of an
+            ID-filename to fail just that file.
+
+    Returns:
+        a list of manifest record dicts
+    """
+    start = time.perf_counter()
+    try:
+        if batch:
+            id_filenames = file_processor(file_paths)
+        else:
+            id_filenames = [file_processor(file_path) for file_path in file_paths]
+        error = None
+    except Exception as exception: # pylint: disable=broad-except
+        id_filenames = [exception] * len(file_paths)
+    seconds = round(time.perf_counter() - start, 3)
+
+    records = []
+    for file_path, id_filename in zip(file_paths, id_filenames):
+        error = None
+        if isinstance(id_filename, Exception):
+            error = '{}: {}'.format(type(id_filename).__name__, id_filename)
+            print('bad image: %s' % error)
+            id_filename = None
+        records.append({
+            'path': os.path.abspath(file_path), # comparable across resumes, see read_manifest
+            'status': 'error' if error else ('ok' if id_filename else 'skipped'),
+            'id_filename': id_filename,
+            'error': error,
+            'seconds': seconds,
+            'pid': os.getpid(),
+        })
+    return records
+
+
+def process_folder(path, file_processor, batch_size=None, workers=1, manifest_path=None,
+                   resume=False):
+    """Runs the given file processing operation on each image in the given
+    directory and its subdirectories.
+
+    With a batch_size, the file processor is instead run on lists of up to
+    batch_size file paths at a time (e.g. faces.process_paths).
+
+    With multiple workers, files (or batches) are spread over a process pool so
+    Vision API waits and pillow CPU work overlap. Each file's status and timing
+    is streamed to a JSONL manifest; with resume, files already recorded as ok
+    in the manifest are skipped.
 
     Args:
         path: a directory path string
-        file_processor: a function(input_path) to run on each image
+        file_processor: a module-level function(input_path) to run on each
+            image, or a function(input_paths) to run on each batch
+        batch_size: optional number of files per batch
+        workers: number of worker processes
+        manifest_path: optional JSONL manifest path
+        resume: whether or not to skip files already in the manifest
+
+    Returns:
+        a dict counting files by status, e.g. {'ok': 10, 'error': 1}
     """
     print('processing directory {} ...'.format(path))
-    for file_name in os.listdir(path):
-        print('processing file {} ...'.format(file_name))
-        file_path = os.path.join(path, file_name)
-        try:
-            file_processor(file_path)
-        except IOError as error:
-            print('bad image: %s' % error)
+    file_paths = list(iter_image_paths(path))
+    if resume and manifest_path:
+        done = read_manifest(manifest_path)
+        file_paths = [file_path for file_path in file_paths
+                      if os.path.abspath(file_path) not in done]
+        print('resuming, {} files already done'.format(len(done)))
+
+    step = batch_size or 1
+    units = [file_paths[start:start + step] for start in range(0, len(file_paths), step)]
+    print('processing {} files in {} units with {} workers ...'.format(
+        len(file_paths), len(units), workers))
+
+    counts = {}
+    manifest_file = open(manifest_path, 'a') if manifest_path else None
+    try:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run_file_processor, file_processor, unit,
+                                           bool(batch_size))
+                           for unit in units]
+                results = (future.result() for future in as_completed(futures))
+                _record_results(results, manifest_file, counts)
+        else:
+            results = (run_file_processor(file_processor, unit, bool(batch_size))
+                       for unit in units)
+            _record_results(results, manifest_file, counts)
+    finally:
+        if manifest_file:
+            manifest_file.close()
+
+    print('...done processing directory {}: {}'.format(path, counts))
+    return counts
+
+
+def _record_results(results, manifest_file, counts):
+    """Streams manifest records to the manifest file as they complete."""
+    for records in results:
+        for record in records:
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+            print('{status} {path} ({seconds}s)'.format(**record))
+            if manifest_file:
+                manifest_file.write(json.dumps(record) + '\n')
+        if manifest_file:
+            manifest_file.flush()
@@ -7,9 +7,98 @@
     https://googlecloudplatform.github.io/google-cloud-python/latest/vision/gapic/v1/types.html#google.cloud.vision_v1.types.Feature
     https://googlecloudplatform.github.io/google-cloud-python/latest/vision/gapic/v1/types.html#google.cloud.vision_v1.types.AnnotateImageResponse
 """
+from io import BytesIO
+import os
+import threading
+
 from google.cloud.vision import enums, ImageAnnotatorClient, types
+from google.protobuf import json_format
+from PIL import Image
+
+from pymoji import (ANNOTATION_CACHE_DIR, ANNOTATION_CACHE_DISK_BYTES,
+    ANNOTATION_CACHE_MEMORY_BYTES, DETECTION_JPEG_QUALITY, DETECTION_MAX_SIZE, MAX_RESULTS,
+    VISION_BATCH_SIZE, VISION_POOL_SIZE)
+from pymoji.cache import get_content_key, TieredCache
+from pymoji.codec import BINARY_MAGIC, decode_json, encode_json, pack_faces, unpack_faces
+from pymoji.constants import VISION_BATCH_LIMIT
+
+
+# Process-wide pool of long-lived Vision API clients. gRPC channels must not be
+# shared across a fork (e.g. gunicorn workers), so the pool remembers which
+# process built it and starts over whenever that changes.
+_CLIENT_POOL = {
+    'pid': None,
+    'lock': threading.Lock(),
+    'clients': [],
+    'next': 0,
+}
+
+# source image formats Vision accepts as-is, see to_proxy_image
+PROXY_FORMATS = ('JPEG', 'MPO', 'PNG', 'GIF')
+
+# counters for how often pooled clients are created VS reused (per process)
+CLIENT_STATS = {
+    'created': 0,
+    'reused': 0,
+}
+
+class VisionError(Exception):
+    """An image the Google Vision API failed to annotate, e.g. within an
+    otherwise successful batch request."""
 
-from pymoji import MAX_RESULTS
+
+# content-addressed cache of serialized face annotations
+# key: hash of the image bytes + detection params + format
+# value: face annotations packed by codec.pack_faces
+ANNOTATION_CACHE = TieredCache(ANNOTATION_CACHE_MEMORY_BYTES,
+                               disk_dir=ANNOTATION_CACHE_DIR,
+                               disk_bytes=ANNOTATION_CACHE_DISK_BYTES)
+
+
+def get_client(pool_size=VISION_POOL_SIZE):
+    """Returns a pooled Google Vision ImageAnnotatorClient. Clients are created
+    lazily, up to pool_size per process, and then handed out round-robin.
+    Thread-safe and fork-safe.
+
+    This call to Google Vision API (ImageAnnotatorClient) will not work on local
+    if you don't have default application credentials. See README.
+    https://cloud.google.com/sdk/gcloud/reference/auth/application-default/login
+
+    Args:
+        pool_size: maximum number of clients (and channels) to keep open
+
+    Returns:
+        a Google Cloud Vision API ImageAnnotatorClient
+    """
+    pid = os.getpid()
+    pool_size = max(pool_size, 1)
+    with _CLIENT_POOL['lock']:
+        if _CLIENT_POOL['pid'] != pid:
+            # fresh process (or a forked child): drop any inherited channels
+            _CLIENT_POOL.update(pid=pid, clients=[], next=0)
+            CLIENT_STATS.update(created=0, reused=0)
+        clients = _CLIENT_POOL['clients']
+        if len(clients) < pool_size:
+            client = ImageAnnotatorClient()
+            clients.append(client)
+            CLIENT_STATS['created'] += 1
+        else:
+            client = clients[_CLIENT_POOL['next'] % pool_size]
+            CLIENT_STATS['reused'] += 1
+        _CLIENT_POOL['next'] += 1
+
+    return client
+
+
+def get_client_stats():
+    """Returns a snapshot of the client pool counters for this process.
+
+    Returns:
+        a dict with 'created', 'reused' and 'pool_size' counts
+    """
+    stats = dict(CLIENT_STATS)
+    stats['pool_size'] = len(_CLIENT_POOL['clients'])
+    return stats
 
 
 def to_vision_image(input_stream=None, input_uri=None):
@@ -37,36 +126,177 @@ def to_vision_image(input_stream=None, input_uri=None):
     return types.Image(content=content, source=source)
 
 
-def detect_faces(image):
+def to_proxy_image(image, max_size=DETECTION_MAX_SIZE, data=None):
+    """Helper that converts the given PIL.Image into a Google Cloud Vision API
+    Image object no larger than max_size pixels on its longest side. Face
+    detection doesn't need full resolution, so big images are sent as a
+    downscaled JPEG proxy instead. Use scale_faces on the results to map them
+    back onto the original image.
+
+    Two fast paths: small images are sent as their original bytes without
+    re-encoding, and still-undecoded JPEGs let the decoder downscale for us
+    (DCT scaling) so the full resolution is never decoded. The latter changes
+    the given image, so pass a fresh Image.open you won't draw on.
+
+    Args:
+        image: a PIL.Image with faces, decoded or straight from Image.open
+        max_size: longest side of the proxy in pixels, None to disable
+        data: the encoded bytes the image was opened from, if still accurate
+
+    Returns:
+        a 2-tuple of the Google Cloud Vision API Image object and the
+            (x, y) scale factors from proxy back to original coordinates
+    """
+    (width, height) = image.size
+    if not max_size or max(width, height) <= max_size:
+        if data is not None and image.format in PROXY_FORMATS:
+            with BytesIO(data) as input_stream:
+                return to_vision_image(input_stream=input_stream), (1.0, 1.0)
+        proxy = image
+    else:
+        ratio = max_size / max(width, height)
+        size = (max(int(width * ratio), 1), max(int(height * ratio), 1))
+        if image.format in ('JPEG', 'MPO'):
+            image.draft('RGB', size) # no-op once decoded
+        proxy = image.resize(size, Image.BILINEAR)
+    if proxy.mode != 'RGB':
+        proxy = proxy.convert('RGB') # JPEG has no alpha
+
+    with BytesIO() as proxy_stream:
+        proxy.save(proxy_stream, format='JPEG', quality=DETECTION_JPEG_QUALITY)
+        print('Sending {}x{} detection proxy ({} bytes)...'.format(
+            proxy.width, proxy.height, proxy_stream.tell()))
+        proxy_stream.seek(0)
+        gv_image = to_vision_image(input_stream=proxy_stream)
+
+    return gv_image, (width / proxy.width, height / proxy.height)
+
+
+def scale_faces(faces, scale):
+    """Scales the bounding polygons and landmarks of the given face annotations
+    in place, e.g. from a detection proxy back onto the original image.
+
+    Args:
+        faces: a list of Face annotation objects
+        scale: a 2-tuple of (x, y) scale factors, see to_proxy_image
+
+    Returns:
+        the same list of Face annotation objects
+    """
+    (scale_x, scale_y) = scale
+    if scale_x == 1 and scale_y == 1:
+        return faces
+
+    for face in faces:
+        for poly in (face.bounding_poly, face.fd_bounding_poly):
+            for vertex in poly.vertices:
+                vertex.x = int(round(vertex.x * scale_x))
+                vertex.y = int(round(vertex.y * scale_y))
+        for landmark in face.landmarks:
+            landmark.position.x *= scale_x
+            landmark.position.y *= scale_y
+    return faces
+
+
+def detect_faces(image, cache=ANNOTATION_CACHE):
     """Finds faces in the given input image and returns a list of Google Vision
     API Face Annotations.
     Currently uses MAX_RESULTS to limit how many labels come back.
 
+    Images passed as content bytes are looked up in the given annotation cache
+    first, so identical uploads skip the network entirely. Images passed by URI
+    always go to the API.
+
     Args:
         image: a Google Cloud Vision API Image object with faces.
+        cache: an optional cache.TieredCache of serialized annotations
 
     Returns:
         a list of Face annotation objects found in the input image.
+
+    Raises:
+        VisionError: if the API failed on the image
     """
+    cache_key = None
+    if cache is not None and image.content:
+        cache_key = get_content_key(image.content, 'FACE_DETECTION', MAX_RESULTS, BINARY_MAGIC)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            faces = from_face_dicts(unpack_faces(cached))
+            print('...{} faces found in cache.'.format(len(faces)))
+            return faces
+
     print('Detecting faces...')
 
-    # This call to Google Vision API (ImageAnnotatorClient) will not work on local
-    # if you don't have default application credentials. See README.
-    # https://cloud.google.com/sdk/gcloud/reference/auth/application-default/login
-    client = ImageAnnotatorClient()
+    client = get_client()
     features = [{
         'type': enums.Feature.Type.FACE_DETECTION,
         'max_results': MAX_RESULTS
     }]
-    faces = client.annotate_image({
+    response = client.annotate_image({
         'image': image,
         'features': features
-        }).face_annotations
+        })
+    if response.error.code:
+        raise VisionError(response.error.message)
+    faces = response.face_annotations
 
     print('...{} faces found.'.format(len(faces)))
+    if cache_key:
+        cache.put(cache_key, pack_faces(faces))
     return faces
 
 
+def to_json_faces(faces):
+    """Serializes the given face annotations to a JSON string matching
+    models.AnnotationsSchema.
+
+    Args:
+        faces: a list of Face annotation objects
+
+    Returns:
+        a JSON string
+    """
+    return encode_json({'faces': faces})
+
+
+def from_face_dicts(face_dicts):
+    """Converts face dicts matching models.FaceSchema back into Google Vision
+    API Face Annotation objects.
+
+    https://developers.google.com/protocol-buffers/docs/reference/python/google.protobuf.json_format-module
+
+    Args:
+        face_dicts: a list of dicts, e.g. from codec.unpack_faces
+
+    Returns:
+        a list of Face annotation objects
+    """
+    return [json_format.ParseDict(face, types.FaceAnnotation()) for face in face_dicts]
+
+
+def from_json_faces(json_string):
+    """Deserializes face annotations written by to_json_faces back into Google
+    Vision API Face Annotation objects.
+
+    Args:
+        json_string: a JSON string matching models.AnnotationsSchema
+
+    Returns:
+        a list of Face annotation objects
+    """
+    return from_face_dicts(decode_json(json_string).get('faces', []))
+
+
+def get_cache_stats():
+    """Returns the annotation cache hit/miss/eviction counters for sizing.
+
+    Returns:
+        a dict of counters, see cache.TieredCache.get_stats
+    """
+    return ANNOTATION_CACHE.get_stats()
+
+
 def detect_labels(image):
     """Finds labels in the given input image and returns a list of Google Vision
     API Label Annotations.
@@ -80,7 +310,7 @@ def detect_labels(image):
     """
     print('Detecting labels...')
 
-    client = ImageAnnotatorClient()
+    client = get_client()
     features = [{
         'type': enums.Feature.Type.LABEL_DETECTION,
         'max_results': MAX_RESULTS
@@ -92,3 +322,80 @@ def detect_labels(image):
 
     print('...{} labels found.'.format(len(labels)))
     return labels
+
+
+def batch_annotate(images, feature_type, batch_size=VISION_BATCH_SIZE):
+    """Runs a single Google Vision feature over many images using the batch
+    annotate API, sending up to batch_size images per request, and returns one
+    AnnotateImageResponse per input image, in order.
+    Currently uses MAX_RESULTS to limit how many annotations come back.
+
+    https://cloud.google.com/vision/docs/reference/rest/v1/images/annotate
+
+    Args:
+        images: a list of Google Cloud Vision API Image objects.
+        feature_type: a Google Vision API enums.Feature.Type value
+        batch_size: images per request, capped at the API limit
+
+    Returns:
+        a list of AnnotateImageResponse objects matching the input images.
+    """
+    batch_size = min(max(batch_size, 1), VISION_BATCH_LIMIT)
+    client = get_client()
+    features = [{
+        'type': feature_type,
+        'max_results': MAX_RESULTS
+    }]
+
+    responses = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        print('Annotating batch of {} images...'.format(len(batch)))
+        response = client.batch_annotate_images([{
+            'image': image,
+            'features': features
+            } for image in batch])
+        responses.extend(response.responses)
+
+    for index, response in enumerate(responses):
+        if response.error.code:
+            print('...image {} failed: {}'.format(index, response.error.message))
+    return responses
+
+
+def detect_faces_batch(images):
+    """Finds faces in each of the given input images with as few Google Vision
+    API round-trips as possible. See batch_annotate.
+
+    Args:
+        images: a list of Google Cloud Vision API Image objects with faces.
+
+    Returns:
+        a list of Face annotation lists, one per input image, with a
+            VisionError in place of each image the API failed on.
+    """
+    print('Detecting faces in {} images...'.format(len(images)))
+    responses = batch_annotate(images, enums.Feature.Type.FACE_DETECTION)
+    faces = [VisionError(response.error.message) if response.error.code
+             else response.face_annotations
+             for response in responses]
+    print('...{} faces found.'.format(sum(len(image_faces) for image_faces in faces
+                                          if not isinstance(image_faces, VisionError))))
+    return faces
+
+
+def detect_labels_batch(images):
+    """Finds labels in each of the given input images with as few Google Vision
+    API round-trips as possible. See batch_annotate.
+
+    Args:
+        images: a list of Google Cloud Vision API Image objects.
+
+    Returns:
+        a list of Label annotation lists, one per input image.
+    """
+    print('Detecting labels in {} images...'.format(len(images)))
+    responses = batch_annotate(images, enums.Feature.Type.LABEL_DETECTION)
+    labels = [response.label_annotations for response in responses]
+    print('...{} labels found.'.format(sum(len(image_labels) for image_labels in labels)))
+    return labels
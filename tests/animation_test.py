@@ -0,0 +1,62 @@
+"""see pymoji/animation.py"""
+from io import BytesIO
+
+from PIL import Image
+
+from pymoji import animation
+from pymoji.models import Face
+
+
+def make_face(left, top, size=40):
+    """Test helper that makes a square face record"""
+    return Face([(left, top), (left + size, top), (left + size, top + size), (left, top + size)])
+
+
+def test_track_faces():
+    """tests pymoji.animation.track_faces"""
+    keyframes = [0, 4]
+    moving = (make_face(0, 0), make_face(40, 0))
+    vanishing = make_face(200, 200)
+    frame_faces = animation.track_faces(keyframes, [[moving[0], vanishing], [moving[1]]], 5)
+
+    assert [len(faces) for faces in frame_faces] == [2, 2, 1, 1, 1]
+    assert [animation.get_center(faces[0]) for faces in frame_faces] == [
+        (20, 20), (30, 20), (40, 20), (50, 20), (60, 20)]
+    assert frame_faces[1][1] is vanishing
+
+
+def test_read_and_save_frames():
+    """tests pymoji.animation.read_frames and pymoji.animation.save_frames"""
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+    source = [Image.new('RGB', (32, 16), color) for color in colors]
+    gif_stream = BytesIO()
+    source[0].save(gif_stream, format='GIF', save_all=True, append_images=source[1:],
+                   duration=[50, 100, 150], loop=0)
+    gif_stream.seek(0)
+
+    frames, durations, loop = animation.read_frames(Image.open(gif_stream))
+    assert [frame.getpixel((0, 0)) for frame in frames] == colors
+    assert durations == [50, 100, 150]
+    assert loop == 0
+
+    output_stream = BytesIO()
+    animation.save_frames(frames, durations, loop, output_stream)
+    output_stream.seek(0)
+    frames, durations, loop = animation.read_frames(Image.open(output_stream))
+    assert [frame.getpixel((0, 0)) for frame in frames] == colors
+    assert durations == [50, 100, 150]
+    assert loop == 0
+
+
+def test_read_frames_budget():
+    """tests pymoji.animation.read_frames subsamples big animations"""
+    source = [Image.new('RGB', (10, 10), (index * 40, 0, 0)) for index in range(6)]
+    gif_stream = BytesIO()
+    source[0].save(gif_stream, format='GIF', save_all=True, append_images=source[1:],
+                   duration=50, loop=0)
+    gif_stream.seek(0)
+
+    frames, durations, _ = animation.read_frames(Image.open(gif_stream), max_pixels=300)
+    assert len(frames) == 3
+    assert durations == [100, 100, 100]
+    assert [frame.getpixel((0, 0))[0] for frame in frames] == [0, 80, 160]
@@ -1,5 +1,10 @@
 """see pymoji/app.py"""
-from pymoji.app import APP
+import json
+
+from pymoji import app, faces, EMOJI_QUALITY
+from pymoji.app import APP, get_job_queue, get_storage
+from pymoji.storage import LocalStorage
+from pymoji.constants import DEMO_PATH
 
 
 def test_index():
@@ -10,3 +15,77 @@ def test_index():
     response = client.get('/')
     assert response.status_code == 200
     assert u'✨📸🕶✨' in response.data.decode('utf-8')
+
+
+def test_index_upload():
+    """tests pymoji.app.APP.index uploads and pymoji.app.APP.emojivision_status"""
+    APP.testing = True
+    client = APP.test_client()
+
+    with open(DEMO_PATH, 'rb') as image:
+        response = client.post('/', data={'image': (image, 'face-input.jpg')})
+    assert response.status_code == 302
+    id_filename = response.headers['Location'].rstrip('/').split('/')[-1]
+    assert id_filename.endswith('face-input.jpg')
+
+    assert isinstance(get_storage(), LocalStorage)
+    get_job_queue().wait(id_filename, timeout=60)
+    response = client.get('/emojivision/{}/status'.format(id_filename))
+    job = json.loads(response.data.decode('utf-8'))
+    assert job['status'] == 'done'
+    assert job['id_filename']
+
+
+def test_index_upload_options(monkeypatch):
+    """tests pymoji.app.APP.index with unknown render options"""
+    APP.testing = True
+    client = APP.test_client()
+    submitted = []
+    class FakeJobQueue(object):
+        """records submitted jobs instead of running them"""
+        def submit(self, job_id, func, **kwargs):
+            """records the job"""
+            submitted.append(kwargs)
+    monkeypatch.setattr(app, 'get_job_queue', FakeJobQueue)
+
+    with open(DEMO_PATH, 'rb') as image:
+        response = client.post('/', data={'image': (image, 'face-input.jpg'),
+                                          'renderer': 'nope', 'quality': 'bogus'})
+    assert response.status_code == 302
+    assert submitted[0]['renderer'] == 'emoji'
+    assert submitted[0]['quality'] == EMOJI_QUALITY
+
+
+def test_after_request():
+    """tests pymoji.app.after_request cache policies"""
+    APP.testing = True
+    client = APP.test_client()
+
+    response = client.get('/robots.txt')
+    assert response.headers['Cache-Control'] == 'public, max-age=86400'
+
+    response = client.get('/static/uploads/face-input.jpg')
+    assert 'immutable' in response.headers['Cache-Control']
+    assert response.headers['ETag']
+
+    response = client.get('/emojivision/nope.jpg/status')
+    assert response.headers['Cache-Control'].startswith('no-store')
+
+    response = client.get('/')
+    assert response.headers['Cache-Control'] == 'no-cache'
+    etag = response.headers['ETag']
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_emojivision_index(monkeypatch):
+    """tests pymoji.app.APP.emojivision_index"""
+    APP.testing = True
+    client = APP.test_client()
+    monkeypatch.setattr(faces, 'DEMO_RUNS', {})
+
+    response = client.get('/emojivision/')
+    assert response.status_code == 302
+    # the demo is only ever rendered once
+    monkeypatch.setattr(faces, 'process_image', None)
+    assert client.get('/emojivision/').headers['Location'] == response.headers['Location']
@@ -0,0 +1,74 @@
+"""see pymoji/cache.py"""
+from pymoji import cache
+
+
+def test_get_content_key():
+    """tests pymoji.cache.get_content_key"""
+    key = cache.get_content_key(b'face', 'FACE_DETECTION', 20)
+    assert key == cache.get_content_key(b'face', 'FACE_DETECTION', 20)
+    assert key != cache.get_content_key(b'face', 'FACE_DETECTION', 5)
+    assert key != cache.get_content_key(b'fade', 'FACE_DETECTION', 20)
+
+
+def test_lru_cache():
+    """tests pymoji.cache.LRUCache"""
+    lru = cache.LRUCache(max_size=10)
+    lru.put('a', b'12345')
+    lru.put('b', b'12345')
+    assert lru.get('a') == b'12345' # 'a' is now most recently used
+    lru.put('c', b'123')
+    assert lru.get('b') is None
+    assert lru.get('a') == b'12345'
+    lru.put('huge', b'12345678901')
+    assert lru.get('huge') is None
+    assert lru.size <= 10
+    assert lru.stats['evictions'] == 1
+
+
+def test_lru_cache_ttl():
+    """tests pymoji.cache.LRUCache expiry"""
+    now = [0]
+    lru = cache.LRUCache(max_size=10, ttl=5, clock=lambda: now[0])
+    lru.put('a', b'12345')
+    now[0] = 4
+    assert lru.get('a') == b'12345'
+    now[0] = 5
+    assert lru.get('a') is None
+    assert lru.size == 0
+    assert lru.stats['expirations'] == 1
+
+
+def test_disk_cache(tmpdir):
+    """tests pymoji.cache.DiskCache"""
+    disk = cache.DiskCache(str(tmpdir), max_bytes=10)
+    disk.put('a', b'12345')
+    disk.put('b', b'12345')
+    assert disk.get('a') == b'12345'
+    assert disk.get('missing') is None
+    disk.put('c', b'12345')
+    assert disk.size <= 10
+    assert disk.stats['evictions'] == 1
+    assert disk.stats['misses'] >= 1
+
+
+def test_disk_cache_overwrite(tmpdir):
+    """tests pymoji.cache.DiskCache counts replaced files once"""
+    directory = tmpdir.join('annotations')
+    disk = cache.DiskCache(str(directory), max_bytes=100)
+    assert not directory.check() # created on first put
+    disk.put('a', b'12345')
+    disk.put('a', b'123')
+    assert disk.size == 3
+    assert disk.get('a') == b'123'
+
+
+def test_tiered_cache(tmpdir):
+    """tests pymoji.cache.TieredCache"""
+    tiered = cache.TieredCache(memory_bytes=5, disk_dir=str(tmpdir), disk_bytes=100)
+    tiered.put('a', b'12345')
+    tiered.put('b', b'12345') # evicts 'a' from memory, but not from disk
+    assert tiered.get('a') == b'12345'
+    stats = tiered.get_stats()
+    assert stats['memory_evictions'] >= 1
+    assert stats['disk_hits'] == 1
+    assert stats['disk_bytes'] == 10
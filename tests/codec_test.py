@@ -0,0 +1,38 @@
+"""see pymoji/codec.py"""
+import json
+
+from pymoji import codec
+from pymoji.models import AnnotationsSchema
+from tests import TEST_JSON_PATH
+
+
+def load_test_json():
+    """Test helper that loads the sample annotations as plain dicts"""
+    with open(TEST_JSON_PATH) as json_file:
+        return json.load(json_file)
+
+
+def test_encode_json():
+    """tests pymoji.codec.encode_json matches the marshmallow schema"""
+    annotation_data = load_test_json()
+    schema_json = AnnotationsSchema().dumps(annotation_data).data
+    assert json.loads(codec.encode_json(annotation_data)) == json.loads(schema_json)
+
+
+def test_decode_json():
+    """tests pymoji.codec.decode_json"""
+    annotation_data = load_test_json()
+    assert codec.decode_json(codec.encode_json(annotation_data)) == annotation_data
+
+    annotation_data['faces'][0]['bounding_poly'] = 'junk'
+    validated = codec.decode_json(json.dumps(annotation_data), validate=True)
+    assert 'bounding_poly' not in validated['faces'][0]
+
+
+def test_pack_faces():
+    """tests pymoji.codec.pack_faces and pymoji.codec.unpack_faces"""
+    faces = load_test_json()['faces'] * 3
+    packed = codec.pack_faces(faces)
+    assert len(packed) < len(codec.encode_json({'faces': faces})) / 4
+    assert codec.unpack_faces(packed) == faces
+    assert codec.unpack_faces(codec.pack_faces([])) == []
@@ -0,0 +1,172 @@
+"""see pymoji/emoji.py"""
+from itertools import product
+import os
+from types import SimpleNamespace
+
+from PIL import Image
+import pytest
+
+from pymoji import emoji
+from pymoji.constants import EMOJI_ATLAS_PATH, EMOJI_SIZE, VERY_UNLIKELY, POSSIBLE, VERY_LIKELY
+from pymoji.models import Face
+
+
+def make_face(**likelihoods):
+    """Test helper that fakes a Google Vision API face annotation"""
+    vertices = [SimpleNamespace(x=x, y=y) for (x, y) in [(10, 20), (50, 20), (50, 70), (10, 70)]]
+    face = {
+        'bounding_poly': SimpleNamespace(vertices=vertices),
+        'sorrow_likelihood': VERY_UNLIKELY,
+        'anger_likelihood': VERY_UNLIKELY,
+        'surprise_likelihood': VERY_UNLIKELY,
+        'joy_likelihood': VERY_UNLIKELY,
+        'headwear_likelihood': VERY_UNLIKELY,
+    }
+    face.update(likelihoods)
+    return SimpleNamespace(**face)
+
+
+def test_get_emoji_code():
+    """tests pymoji.emoji.get_emoji_code"""
+    assert emoji.get_emoji_code(make_face()) == "1f642" # slightly smiling face
+    assert emoji.get_emoji_code(make_face(joy_likelihood=VERY_LIKELY)) == "1f606"
+    assert emoji.get_emoji_code(make_face(headwear_likelihood=VERY_LIKELY)) == "1f920"
+    assert emoji.get_emoji_code(make_face(sorrow_likelihood=POSSIBLE,
+                                          joy_likelihood=VERY_LIKELY)) == "1f61f"
+
+    glasses = SimpleNamespace(description="glasses", score=0.9)
+    assert emoji.get_emoji_code(make_face(), [glasses]) == "1f913" # nerd face
+
+
+def test_emoji_atlas(tmpdir, monkeypatch):
+    """tests pymoji.emoji.build_emoji_atlas and pymoji.emoji.load_emoji_atlas"""
+    colors = {"1f642": (251, 200, 83, 255), "1f913": (0, 0, 255, 255)}
+    monkeypatch.setattr(emoji, 'download_image',
+                        lambda url: Image.new('RGBA', (128, 128), colors[url[-9:-4]]))
+    atlas_path = str(tmpdir.join('atlas.png'))
+    index_path = str(tmpdir.join('atlas.json'))
+    emoji.build_emoji_atlas(sorted(colors), atlas_path, index_path)
+
+    monkeypatch.setattr(emoji, 'EMOJI', {})
+    monkeypatch.setitem(emoji.ATLAS_STATE, 'loaded', False)
+    assert emoji.load_emoji_atlas(atlas_path + '.missing', index_path) == 0
+    assert not emoji.ATLAS_STATE['loaded'] # retried once the atlas exists
+    assert emoji.load_emoji_atlas(atlas_path, index_path) == 2
+    for code, color in colors.items():
+        template = emoji.get_emoji_template(code, use_cdn=False)
+        assert template.size == (128, 128)
+        assert template.getpixel((64, 64)) == color
+
+    with pytest.raises(KeyError):
+        emoji.get_emoji_template("1f644", use_cdn=False)
+
+
+@pytest.mark.skipif(not os.path.isfile(EMOJI_ATLAS_PATH),
+                    reason='no committed emoji atlas, run ./cli buildemoji')
+def test_committed_emoji_atlas(monkeypatch):
+    """tests pymoji.emoji.load_emoji_atlas with the committed sprite sheet"""
+    monkeypatch.setattr(emoji, 'EMOJI', {})
+    monkeypatch.setitem(emoji.ATLAS_STATE, 'loaded', False)
+    emoji.load_emoji_atlas()
+    for code in emoji.EMOJI_TABLE.humor_rank:
+        template = emoji.get_emoji_template(code, use_cdn=False)
+        assert template.size == (EMOJI_SIZE, EMOJI_SIZE)
+        assert template.getbbox() # not a blank cell
+
+
+def test_get_emoji_image(monkeypatch):
+    """tests pymoji.emoji.get_emoji_image"""
+    monkeypatch.setitem(emoji.EMOJI, "1f642", Image.new('RGBA', (128, 128), (251, 200, 83, 255)))
+    monkeypatch.setattr(emoji, 'RESIZED_EMOJI',
+                        emoji.LRUCache(1024 * 1024, sizeof=emoji.RESIZED_EMOJI.sizeof))
+
+    first = emoji.get_emoji_image("1f642", (10, 10, 110, 60))
+    assert first.size == emoji.get_emoji_size((10, 10, 110, 60))
+    second = emoji.get_emoji_image("1f642", (10, 10, 110, 60))
+    assert second is first
+    stats = emoji.get_emoji_cache_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['bytes'] == first.width * first.height * 4
+
+
+def test_get_mipmap(monkeypatch):
+    """tests pymoji.emoji.get_mipmap"""
+    monkeypatch.setitem(emoji.EMOJI, "1f642", Image.new('RGBA', (128, 128), (251, 200, 83, 255)))
+    monkeypatch.setattr(emoji, 'RESIZED_EMOJI',
+                        emoji.LRUCache(4 * 1024 * 1024, sizeof=emoji.RESIZED_EMOJI.sizeof))
+
+    assert emoji.get_mipmap("1f642", 100, 50) is emoji.EMOJI["1f642"]
+    level = emoji.get_mipmap("1f642", 129, 20)
+    assert level.size == (256, 256)
+    assert emoji.get_mipmap("1f642", 200, 200) is level
+    assert emoji.get_mipmap("1f642", 1000, 900).size == (512, 512)
+    # levels count against the cache's byte budget
+    assert emoji.RESIZED_EMOJI.size == (256 * 256 + 512 * 512) * 4
+
+    for quality in emoji.EMOJI_RESAMPLE:
+        image = emoji.get_emoji_image("1f642", (0, 0, 300, 200), quality)
+        assert image.size == emoji.get_emoji_size((0, 0, 300, 200))
+        assert image.getpixel((150, 100)) == (251, 200, 83, 255)
+
+
+def test_replace_faces(monkeypatch):
+    """tests pymoji.emoji.replace_faces draws the nearest face last"""
+    monkeypatch.setitem(emoji.EMOJI, "1f642", Image.new('RGBA', (128, 128), (251, 200, 83, 255)))
+    monkeypatch.setitem(emoji.EMOJI, "1f606", Image.new('RGBA', (128, 128), (0, 0, 255, 255)))
+    near = Face([(20, 30), (60, 30), (60, 70), (20, 70)], joy_likelihood=VERY_LIKELY)
+    far = Face([(10, 10), (50, 10), (50, 50), (10, 50)])
+    image = Image.new('RGB', (80, 80))
+    emoji.replace_faces(image, [near, far], use_gva_labels=False)
+    assert image.getpixel((40, 50)) == (0, 0, 255)
+    assert image.getpixel((15, 15)) == (251, 200, 83)
+
+
+def test_emoji_table():
+    """tests pymoji.emoji.EmojiTable matches ranking every candidate"""
+    table = emoji.EmojiTable()
+    rank = emoji.HUMOR_RANK.index
+    for likelihoods in product(range(emoji.LIKELIHOOD_COUNT), repeat=5):
+        face = make_face(**dict(zip(('sorrow_likelihood', 'anger_likelihood',
+                                     'surprise_likelihood', 'joy_likelihood',
+                                     'headwear_likelihood'), likelihoods)))
+        candidates = [emoji.SORROW_MAP.get(face.sorrow_likelihood, emoji.DEFAULT_CODE),
+                      emoji.ANGER_MAP.get(face.anger_likelihood, emoji.DEFAULT_CODE),
+                      emoji.SURPRISE_MAP.get(face.surprise_likelihood, emoji.DEFAULT_CODE),
+                      emoji.JOY_MAP.get(face.joy_likelihood, emoji.DEFAULT_CODE)]
+        if face.headwear_likelihood > POSSIBLE:
+            candidates.append("1f920")
+        assert table.lookup(face) == min(candidates, key=rank)
+
+    labels = [SimpleNamespace(description=description) for description in ("eyewear", "kiss")]
+    assert table.lookup(make_face(), labels) == "1f60d" # smiling face with heart eyes
+    assert table.lookup(make_face(), labels[:1]) == "1f642"
+    assert table.lookup(make_face(joy_likelihood=42)) == "1f642"
+
+
+def test_emoji_table_rules():
+    """tests pymoji.emoji.EmojiTable with rules overridden, e.g. from config"""
+    table = emoji.EmojiTable({
+        'joy': {VERY_LIKELY: "1f602"}, # face with tears of joy
+        'humor_rank': ["1f602"] + emoji.HUMOR_RANK,
+    })
+    assert table.lookup(make_face(joy_likelihood=VERY_LIKELY)) == "1f602"
+    assert table.lookup(make_face(joy_likelihood=POSSIBLE)) == "1f642"
+    assert table.lookup(make_face(joy_likelihood=VERY_LIKELY),
+                        [SimpleNamespace(description="glasses")]) == "1f602"
+
+    with pytest.raises(ValueError):
+        emoji.EmojiTable({'joy': {VERY_LIKELY: "1f602"}})
+
+
+def test_get_render_version():
+    """tests pymoji.emoji.get_render_version"""
+    table = emoji.EmojiTable()
+    version = emoji.get_render_version(table, use_gva_labels=False)
+    assert emoji.get_render_version(emoji.EmojiTable(), use_gva_labels=False) == version
+    assert emoji.get_render_version(table, use_gva_labels=True) != version
+    tuned = emoji.EmojiTable({
+        'joy': {VERY_LIKELY: "1f602"},
+        'humor_rank': ["1f602"] + emoji.HUMOR_RANK,
+    })
+    assert emoji.get_render_version(tuned, use_gva_labels=False) != version
@@ -1,10 +1,11 @@
 """see pymoji/faces.py"""
+from io import BytesIO
 import os
 
 from PIL import Image
 
 from pymoji.constants import DEMO_PATH, OUTPUT_DIR
-from pymoji import faces, utils
+from pymoji import faces, storage, utils, vision
 
 
 def test_process_path():
@@ -32,6 +33,131 @@ def test_process_local():
     pass
 
 
-def test_process_cloud():
+def test_process_cloud(monkeypatch):
     """ tests pymoji.faces.process_cloud"""
-    pass
+    fake_storage = storage.MemoryStorage()
+    monkeypatch.setattr(faces, 'GCSStorage', lambda: fake_storage)
+
+    with open(DEMO_PATH, 'rb') as input_file:
+        id_filename = faces.process_cloud(input_file, 'face-input.jpg', 'image/jpeg', 'emoji')
+
+    artifacts = [path for path in fake_storage.blobs if not path.startswith('index/')]
+    assert sorted(artifacts) == sorted([
+        'gen/' + utils.get_json_name(id_filename),
+        'gen/' + utils.get_output_name(id_filename),
+        'uploads/' + id_filename,
+    ])
+    with open(DEMO_PATH, 'rb') as input_file:
+        assert fake_storage.blobs['uploads/' + id_filename] == (input_file.read(), 'image/jpeg')
+    assert fake_storage.blobs['gen/' + utils.get_json_name(id_filename)][1] == 'application/json'
+
+
+def test_process_image():
+    """tests pymoji.faces.process_image"""
+    fake_storage = storage.MemoryStorage()
+    with open(DEMO_PATH, 'rb') as input_file:
+        id_filename = faces.process_image(input_file, 'face-input.jpg', 'emoji', fake_storage)
+
+    output, mime_type = fake_storage.blobs['gen/' + utils.get_output_name(id_filename)]
+    assert mime_type == 'image/jpeg'
+    assert Image.open(BytesIO(output)).size == (1080, 720)
+
+
+def test_process_paths():
+    """tests pymoji.faces.process_paths"""
+    id_filenames = faces.process_paths([DEMO_PATH, 'not-an-image.txt', DEMO_PATH])
+    assert id_filenames[1] is None
+    for id_filename in (id_filenames[0], id_filenames[2]):
+        output_filename = utils.get_output_name(id_filename)
+        assert os.path.isfile(os.path.join(OUTPUT_DIR, output_filename))
+
+
+def test_process_paths_vision_error(monkeypatch):
+    """tests pymoji.faces.process_paths when Vision fails on one image"""
+    detect_faces_batch = faces.detect_faces_batch
+    def fake_detect_faces_batch(images):
+        """fails the first image"""
+        return [vision.VisionError('quota')] + detect_faces_batch(images[1:])
+    monkeypatch.setattr(faces, 'detect_faces_batch', fake_detect_faces_batch)
+
+    id_filenames = faces.process_paths([DEMO_PATH, DEMO_PATH])
+    assert isinstance(id_filenames[0], vision.VisionError)
+    assert id_filenames[1].endswith('face-input.jpg')
+
+
+def test_face_run():
+    """tests pymoji.faces.FaceRun"""
+    with open(DEMO_PATH, 'rb') as input_file:
+        with faces.FaceRun(input_file, 'face-input.jpg') as run:
+            assert run.format == 'JPEG'
+            assert run.image.size == (1080, 720)
+            assert 'face-input.jpg' in run.id_filename
+            input_file.seek(0)
+            assert run.open_input().read() == input_file.read()
+            assert len(run.detect()) == 1
+            run.unload()
+            assert run.image.size == (1080, 720) # decoded again on demand
+
+
+def test_process_image_dedup(monkeypatch):
+    """tests pymoji.faces.process_image deduplication"""
+    fake_storage = storage.MemoryStorage()
+    with open(DEMO_PATH, 'rb') as input_file:
+        id_filename = faces.process_image(input_file, 'face-input.jpg', 'emoji', fake_storage,
+                                          dedup=True)
+    blob_count = len(fake_storage.blobs)
+
+    # an identical upload must not hit Vision again
+    monkeypatch.setattr(faces.FaceRun, 'detect', None)
+    with open(DEMO_PATH, 'rb') as input_file:
+        assert faces.process_image(input_file, 'copy.jpg', 'emoji', fake_storage,
+                                   dedup=True) == id_filename
+    assert len(fake_storage.blobs) == blob_count
+
+    # new rendering code or emoji rules start over
+    dedup_path = faces.get_dedup_path(b'face', 'emoji', 'fast')
+    monkeypatch.setattr(faces, 'get_render_version', lambda: 'tuned')
+    assert faces.get_dedup_path(b'face', 'emoji', 'fast') != dedup_path
+
+
+def test_face_run_animated():
+    """tests pymoji.faces.FaceRun with an animated GIF"""
+    demo = Image.open(DEMO_PATH)
+    frames = [demo.transform(demo.size, Image.AFFINE, (1, 0, -shift, 0, 1, 0))
+              for shift in range(0, 40, 10)]
+    gif_stream = BytesIO()
+    frames[0].save(gif_stream, format='GIF', save_all=True, append_images=frames[1:],
+                   duration=80, loop=0)
+    gif_stream.seek(0)
+
+    with faces.FaceRun(gif_stream, 'face-input.gif') as run:
+        assert run.is_animated
+        assert run.detect()
+        output_stream = BytesIO()
+        run.render('emoji', output_stream)
+
+    output_stream.seek(0)
+    output = Image.open(output_stream)
+    assert output.n_frames == len(frames)
+    assert output.info['duration'] == 80
+    assert output.info['loop'] == 0
+
+
+def test_face_run_mpo():
+    """tests pymoji.faces.FaceRun with a multi-picture JPEG"""
+    demo = Image.open(DEMO_PATH)
+    mpo_stream = BytesIO()
+    demo.save(mpo_stream, format='MPO', save_all=True, append_images=[demo.copy()])
+    mpo_stream.seek(0)
+    assert Image.open(mpo_stream).is_animated # as Pillow sees it
+    mpo_stream.seek(0)
+
+    fake_storage = storage.MemoryStorage()
+    id_filename = faces.process_image(mpo_stream, 'face-input.jpg', 'emoji', fake_storage,
+                                      mime_type='image/jpeg', dedup=False)
+    (data, content_type) = fake_storage.blobs['gen/' + utils.get_output_name(id_filename)]
+    assert content_type == 'image/jpeg'
+    output = Image.open(BytesIO(data))
+    assert output.format == 'JPEG'
+    assert output.size == (1080, 720)
+    assert getattr(output, 'n_frames', 1) == 1
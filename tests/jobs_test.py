@@ -0,0 +1,57 @@
+"""see pymoji/jobs.py"""
+from io import BytesIO
+import json
+import threading
+import time
+
+from pymoji import jobs, storage
+
+
+def fail():
+    """a job that always fails"""
+    raise ValueError('bad image')
+
+
+def test_local_job_queue():
+    """tests pymoji.jobs.LocalJobQueue"""
+    shared_storage = storage.MemoryStorage()
+    queue = jobs.LocalJobQueue(shared_storage, max_workers=2)
+    assert queue.get_status('nope') is None
+
+    queue.submit('good.jpg', lambda name: name, 'old.jpg')
+    queue.submit('bad.jpg', fail)
+    assert queue.wait('good.jpg')['id_filename'] == 'old.jpg'
+    bad = queue.wait('bad.jpg')
+    assert bad['status'] == jobs.ERROR
+    assert bad['error'] == jobs.ERROR_MESSAGE # no exception details for clients
+
+    # other processes see statuses through the shared storage
+    other_queue = jobs.LocalJobQueue(shared_storage)
+    assert other_queue.get_status('good.jpg')['status'] == jobs.DONE
+
+    # the queued record is shared before submit returns, e.g. for the redirect
+    started = threading.Event()
+    queue.submit('slow.jpg', started.wait)
+    assert other_queue.get_status('slow.jpg')['status'] in jobs.PENDING_STATUSES
+    started.set()
+    assert queue.wait('slow.jpg')['status'] == jobs.DONE
+
+
+def test_local_job_queue_timeout():
+    """tests pymoji.jobs.LocalJobQueue with lost and old jobs"""
+    shared_storage = storage.MemoryStorage()
+    queue = jobs.LocalJobQueue(shared_storage, timeout=60)
+    now = time.time()
+
+    # queued by a worker that went away
+    lost_id = '{}_lost.jpg'.format(int(now * 1000))
+    record = {'job_id': lost_id, 'status': jobs.QUEUED, 'id_filename': None, 'error': None,
+              'queued_at': now - 120}
+    shared_storage.save(BytesIO(json.dumps(record).encode('utf-8')),
+                        jobs.get_status_path(lost_id), 'application/json')
+    assert queue.get_status(lost_id)['status'] == jobs.ERROR
+
+    # old runs are never looked up
+    old_id = '{}_old.jpg'.format(int((now - 120) * 1000))
+    shared_storage.load = None
+    assert queue.get_status(old_id) is None
@@ -0,0 +1,40 @@
+"""see pymoji/slack.py"""
+from pymoji import slack
+
+
+def test_slack_notifier():
+    """tests pymoji.slack.SlackNotifier"""
+    messages = []
+    def fake_send(msg, **_):
+        """records instead of posting"""
+        messages.append(msg)
+        return 200
+
+    notifier = slack.SlackNotifier(interval=0.2, max_queue=3, send=fake_send)
+    assert all(notifier.notify('{}_face.jpg'.format(i)) for i in range(3))
+    notifier.flush()
+
+    # one digest for the whole burst
+    assert len(messages) == 1
+    assert '3 uploads' in messages[0]
+    assert '2_face.jpg' in messages[0]
+    assert notifier.stats['messages'] == 1
+    assert notifier.stats['dropped'] == 0
+
+
+def test_slack_notifier_failures():
+    """tests pymoji.slack.SlackNotifier survives failed sends"""
+    replies = [ValueError('boom'), 500, 200]
+    def fake_send(_msg, **_):
+        """fails, then gets an error reply, then works"""
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    notifier = slack.SlackNotifier(interval=0, max_queue=3, send=fake_send)
+    for i in range(3):
+        notifier.notify('{}_face.jpg'.format(i))
+        notifier.flush()
+    assert notifier.stats['failures'] == 2
+    assert notifier.stats['messages'] == 1
@@ -0,0 +1,61 @@
+"""see pymoji/storage.py"""
+from io import BytesIO
+from types import SimpleNamespace
+
+from pymoji import storage
+
+
+def test_local_storage(tmpdir):
+    """tests pymoji.storage.LocalStorage"""
+    local_storage = storage.LocalStorage(str(tmpdir))
+    assert local_storage.load('gen/foo.json') is None
+    assert not local_storage.exists('gen/foo.json')
+
+    url = local_storage.save(BytesIO(b'{}'), 'gen/foo.json', 'application/json')
+    assert url == '/static/gen/foo.json'
+    assert local_storage.exists('gen/foo.json')
+    assert local_storage.load('gen/foo.json') == b'{}'
+    assert tmpdir.join('gen', 'foo.json').read() == '{}'
+
+
+def test_memory_storage():
+    """tests pymoji.storage.MemoryStorage"""
+    memory_storage = storage.MemoryStorage()
+    assert not memory_storage.exists('uploads/foo.jpg')
+
+    memory_storage.save(BytesIO(b'jpeg'), 'uploads/foo.jpg', 'image/jpeg')
+    assert memory_storage.load('uploads/foo.jpg') == b'jpeg'
+    assert memory_storage.blobs['uploads/foo.jpg'] == (b'jpeg', 'image/jpeg')
+
+
+def test_get_gcs_bucket():
+    """tests pymoji.storage.get_gcs_bucket"""
+    bucket = storage.get_gcs_bucket('pymoji-test')
+    assert storage.get_gcs_bucket('pymoji-test') is bucket
+
+    # as if forked: inherited connections are dropped, not reused
+    storage._GCS['pid'] = -1 # pylint: disable=protected-access
+    assert storage.get_gcs_bucket('pymoji-test') is not bucket
+    assert storage.GCSStorage('pymoji-test').get_url('gen/foo.json') == \
+        'http://storage.googleapis.com/pymoji-test/gen/foo.json'
+
+
+def test_gcs_storage(monkeypatch):
+    """tests pymoji.storage.GCSStorage uploads with a known size"""
+    uploads = []
+
+    class FakeBlob(object):
+        """records uploads"""
+        cache_control = None
+
+        def upload_from_file(self, data_stream, content_type=None, size=None):
+            """fakes google.cloud.storage.Blob.upload_from_file"""
+            uploads.append((data_stream.read(size), content_type, size, self.cache_control))
+
+    fake_bucket = SimpleNamespace(blob=lambda path: FakeBlob())
+    monkeypatch.setattr(storage, 'get_gcs_bucket', lambda bucket_name, project: fake_bucket)
+    gcs_storage = storage.GCSStorage('pymoji-test')
+    data_stream = BytesIO(b'xx{}')
+    data_stream.seek(2)
+    gcs_storage.save(data_stream, 'gen/foo.json', 'application/json')
+    assert uploads == [(b'{}', 'application/json', 2, storage.IMMUTABLE_CACHE_CONTROL)]
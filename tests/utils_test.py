@@ -1,8 +1,14 @@
 """see pymoji/utils.py"""
+import json
+import os
 from tempfile import NamedTemporaryFile
 from time import sleep
+from types import SimpleNamespace
 
-from pymoji import utils
+from PIL import Image
+
+from pymoji import cache, utils
+from pymoji.constants import DEMO_PATH
 from tests import TEST_JSON_PATH
 
 
@@ -34,9 +40,65 @@ def test_load_json():
         assert face['bounding_poly']['vertices'][0]['y'] == 178
 
 
-def test_download_json():
+def test_load_faces():
+    """ tests pymoji.utils.load_faces"""
+    with open(TEST_JSON_PATH) as json_file:
+        face = utils.load_faces(json_file)[0]
+    assert face.detection_confidence == 0.9950907230377197
+    assert face.joy_likelihood == 1
+    assert face.headwear_likelihood == 5
+    assert face.box[:2] == (395, 178)
+    assert face.depth == 178
+    with NamedTemporaryFile(suffix='.json', mode='w+') as json_stream:
+        utils.write_json({'faces': [face]}, json_stream)
+        json_stream.seek(0)
+        assert utils.load_faces(json_stream) == [face]
+
+
+def test_get_peak_memory(monkeypatch):
+    """ tests pymoji.utils.get_peak_memory"""
+    usage = SimpleNamespace(ru_maxrss=2048)
+    monkeypatch.setattr(utils.resource, 'getrusage', lambda who: usage)
+    monkeypatch.setattr(utils.sys, 'platform', 'linux')
+    assert utils.get_peak_memory() == 2048 * 1024
+    monkeypatch.setattr(utils.sys, 'platform', 'darwin')
+    assert utils.get_peak_memory() == 2048
+
+
+def test_get_http_session():
+    """ tests pymoji.utils.get_http_session"""
+    session = utils.get_http_session()
+    assert utils.get_http_session() is session
+
+    # as if forked: inherited connections are dropped, not reused
+    utils._HTTP_SESSION['pid'] = -1 # pylint: disable=protected-access
+    assert utils.get_http_session() is not session
+
+
+def test_download_json(monkeypatch):
     """ tests pymoji.utils.download_json"""
-    pass
+    with open(TEST_JSON_PATH) as json_file:
+        text = json_file.read()
+    downloads = []
+    class FakeSession(object):
+        """fakes a requests.Session"""
+        def get(self, uri):
+            """counts and fakes a download"""
+            downloads.append(uri)
+            return SimpleNamespace(text=text, ok=True)
+    monkeypatch.setattr(utils, 'get_http_session', FakeSession)
+
+    metadata_cache = cache.LRUCache(10, sizeof=lambda _: 1, ttl=60)
+    data = utils.download_json('http://cdn/face-input-meta.json', metadata_cache)
+    assert data['faces'][0]['headwear_likelihood'] == 5
+    assert utils.download_json('http://cdn/face-input-meta.json', metadata_cache) is data
+    assert downloads == ['http://cdn/face-input-meta.json']
+
+    # invalid metadata is returned but not cached
+    text = '{"faces": [{"bounding_poly": "nope"}]}'
+    for _ in range(2):
+        utils.download_json('http://cdn/bad-meta.json', metadata_cache)
+    assert downloads[1:] == ['http://cdn/bad-meta.json'] * 2
 
 
 def test_download_image():
@@ -46,7 +108,10 @@ def test_download_image():
 
 def test_orient_image():
     """ tests pymoji.utils.orient_image"""
-    pass
+    # upright images take the lossless fast path and are returned as-is
+    image = Image.open(DEMO_PATH)
+    assert utils.get_exif_orientation(image) == 1
+    assert utils.orient_image(image) is image
 
 
 def test_get_id_name():
@@ -61,6 +126,55 @@ def test_get_id_name():
     assert name_two > name_one
 
 
-def test_process_folder():
+def fake_file_processor(input_path):
+    """Test helper that stands in for faces.process_path"""
+    if 'bad' in input_path:
+        raise IOError('cannot identify image file')
+    return os.path.basename(input_path)
+
+
+def fake_batch_processor(input_paths):
+    """Test helper that stands in for faces.process_paths"""
+    return [IOError('vision failed') if 'bad' in input_path else os.path.basename(input_path)
+            for input_path in input_paths]
+
+
+def test_process_folder(tmpdir):
     """ tests pymoji.utils.process_folder"""
-    pass
+    for name in ['a.jpg', 'bad.jpg', 'notes.txt', 'sub/b.png', 'sub/deeper/c.gif']:
+        tmpdir.join(name).ensure()
+    manifest_path = str(tmpdir.join('manifest.jsonl'))
+
+    counts = utils.process_folder(str(tmpdir), fake_file_processor, workers=2,
+                                  manifest_path=manifest_path)
+    assert counts == {'ok': 3, 'error': 1}
+    with open(manifest_path) as manifest_file:
+        records = [json.loads(line) for line in manifest_file]
+    assert len(records) == 4
+    assert all('seconds' in record for record in records)
+
+    # only the failed file is retried
+    counts = utils.process_folder(str(tmpdir), fake_file_processor,
+                                  manifest_path=manifest_path, resume=True)
+    assert counts == {'error': 1}
+
+    # the same folder by a relative path is still recognized as done
+    with tmpdir.join('sub').as_cwd():
+        counts = utils.process_folder('..', fake_file_processor,
+                                      manifest_path=manifest_path, resume=True)
+    assert counts == {'error': 1}
+
+    # batch processors can fail single files
+    counts = utils.process_folder(str(tmpdir), fake_batch_processor, batch_size=10)
+    assert counts == {'ok': 3, 'error': 1}
+
+
+def test_make_buffer():
+    """ tests pymoji.utils.make_buffer keeps encoded images in memory"""
+    image = Image.open(DEMO_PATH)
+    for image_format in ('JPEG', 'GIF', 'PNG'):
+        with utils.make_buffer() as buffer:
+            image.save(buffer, format=image_format)
+            assert not buffer._rolled # pylint: disable=protected-access
+            buffer.seek(0)
+            assert Image.open(buffer).size == image.size
@@ -1,4 +1,8 @@
 """see pymoji/vision.py"""
+from io import BytesIO
+
+from PIL import Image
+
 from pymoji.constants import DEMO_PATH
 from pymoji import vision
 
@@ -51,3 +55,78 @@ def test_detect_labels():
                 found_glasses = True
                 continue
         assert found_glasses
+
+
+def test_get_client():
+    """ tests pymoji.vision.get_client"""
+    first = vision.get_client(pool_size=1)
+    before = vision.get_client_stats()
+    second = vision.get_client(pool_size=1)
+    after = vision.get_client_stats()
+    assert first is second
+    assert after['created'] == before['created']
+    assert after['reused'] == before['reused'] + 1
+    assert after['pool_size'] >= 1
+
+    # as if forked: the inherited pool is dropped, not reused
+    vision._CLIENT_POOL['pid'] = -1 # pylint: disable=protected-access
+    assert vision.get_client(pool_size=1) is not first
+    assert vision.get_client_stats() == {'created': 1, 'reused': 0, 'pool_size': 1}
+
+
+def test_detect_faces_batch():
+    """ tests pymoji.vision.detect_faces_batch"""
+    # assumes vision.to_vision_image works for a stream
+    gv_images = []
+    for _ in range(3):
+        with open(DEMO_PATH, 'rb') as input_file:
+            gv_images.append(vision.to_vision_image(input_stream=input_file))
+    batch_faces = vision.detect_faces_batch(gv_images)
+    assert len(batch_faces) == 3
+    for faces in batch_faces:
+        assert_valid_demo_face(faces[0])
+
+
+def test_detect_faces_cache():
+    """ tests pymoji.vision.detect_faces with the annotation cache"""
+    # assumes vision.to_vision_image works for a stream
+    with open(DEMO_PATH, 'rb') as input_file:
+        gv_image = vision.to_vision_image(input_stream=input_file)
+    vision.detect_faces(gv_image) # make sure the demo image is cached
+    before = vision.get_cache_stats()
+    face = vision.detect_faces(gv_image)[0]
+    after = vision.get_cache_stats()
+    assert_valid_demo_face(face)
+    assert after['memory_hits'] == before['memory_hits'] + 1
+
+
+def test_detect_labels_batch():
+    """ tests pymoji.vision.detect_labels_batch"""
+    # assumes vision.to_vision_image works for a stream
+    gv_images = []
+    for _ in range(2):
+        with open(DEMO_PATH, 'rb') as input_file:
+            gv_images.append(vision.to_vision_image(input_stream=input_file))
+    batch_labels = vision.detect_labels_batch(gv_images)
+    assert len(batch_labels) == 2
+    for labels in batch_labels:
+        assert any(label.description == "glasses" for label in labels)
+
+
+def test_to_proxy_image():
+    """ tests pymoji.vision.to_proxy_image"""
+    # assumes vision.detect_faces and vision.scale_faces work correctly
+    image = Image.open(DEMO_PATH)
+    gv_image, scale = vision.to_proxy_image(image, max_size=540)
+    assert scale == (2.0, 2.0)
+    face = vision.scale_faces(vision.detect_faces(gv_image), scale)[0]
+    assert_valid_demo_face(face)
+    assert image.size == (540, 360) # DCT scaled while decoding
+
+    # small enough already: the original bytes go as-is
+    with open(DEMO_PATH, 'rb') as input_file:
+        data = input_file.read()
+    image = Image.open(BytesIO(data))
+    gv_image, scale = vision.to_proxy_image(image, max_size=1080, data=data)
+    assert scale == (1.0, 1.0)
+    assert gv_image.content == data